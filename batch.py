@@ -0,0 +1,266 @@
+"""
+Batch API and CLI that answers many questions at once, e.g. for scheduled reports.
+
+Questions are looked up in the translation cache and the query templates first
+(see templates.py). The remaining ones are
+translated by the LLM through an LLMExecutor (llm_client.py), with at most
+`concurrency` calls in flight, per-call timeouts, hedging and jittered retries
+on rate limit and other transient errors.
+Each translation is executed on a pool of `db_workers` threads as soon as it
+arrives, through the same QueryGuard and result cache as the web app, and every
+result is written as one JSON line when it finishes:
+
+    python batch.py questions.txt --database mysql --concurrency 8 --output results.jsonl
+
+A question file has one question per line, or JSON lines with a "question" and
+optionally a "database" ("mysql" or "mongo") for batches mixing both.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from dotenv import load_dotenv
+from cache import ResultCache, TranslationCache
+from deadline import Deadline
+from encoders import to_json
+from guard import QueryGuard, describe_decision
+from llm_client import LLMExecutor
+from metrics import record_llm_usage
+from templates import TemplateStore
+
+log = logging.getLogger(__name__)
+
+DATABASES = ("mysql", "mongo")
+
+
+def read_questions(lines, default_database="mysql"):
+    items = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            entry = json.loads(line)
+            items.append({"question": entry["question"], "database": entry.get("database", default_database)})
+        else:
+            items.append({"question": line, "database": default_database})
+
+    for item in items:
+        if item["database"] not in DATABASES:
+            raise ValueError(f"Unknown database '{item['database']}', expected one of {', '.join(DATABASES)}.")
+    return items
+
+
+def collect_rows(output, max_rows):
+    # Reads the rest of a streamed SELECT, up to max_rows, and always releases its connection
+    rows = list(output["sql_result"])
+    stream = output.get("stream")
+    try:
+        while stream and not stream.exhausted and len(rows) < max_rows:
+            rows += stream.fetch_page()
+        truncated = len(rows) > max_rows or bool(stream and not stream.exhausted)
+    finally:
+        if stream:
+            stream.close()
+    return rows[:max_rows], truncated
+
+
+def result_record(item, output, max_rows):
+    record = {"question": item["question"], "database": item["database"]}
+    if not isinstance(output, dict):
+        record["error"] = output or "The query could not be executed."
+        return record
+
+    record["intent"] = output.get("intent")
+    record["query"] = output.get("query", output.get("mongo_query"))
+    if (output.get("guard") or {}).get("action") == "reject":
+        record["error"] = describe_decision(output["guard"])
+    elif record["intent"] == "schema":
+        record["answer"] = output["result"]
+    elif "rows_mod" in output:
+        record["rows_affected"] = output["rows_mod"]
+    elif isinstance(output.get("sql_result"), str):
+        record["result"] = output["sql_result"]
+    elif "sql_result" in output:
+        rows, truncated = collect_rows(output, max_rows)
+        record.update({
+            "columns": output["columns"],
+            "rows": [list(row) for row in rows],
+            "total_rows": output.get("total_rows"),
+            "truncated": truncated,
+        })
+    else:
+        record.update({"rows": output["output"], "truncated": output["truncated"]})
+    return record
+
+
+def run_batch(items, handlers, llm, write, concurrency=8, db_workers=8, max_rows=1000, timeout=None, max_attempts=5):
+    """
+    Answers every item ({"question", "database"}) with handlers[database] and
+    calls write(record) once per item, in the order they finish. write() is
+    only ever called by one thread at a time. Returns summary counts.
+
+    A bare chat model is wrapped in an LLMExecutor allowing `concurrency`
+    requests and `max_attempts` attempts per call.
+    """
+    if not isinstance(llm, LLMExecutor):
+        llm = LLMExecutor(llm, max_attempts=max_attempts, max_concurrency=concurrency)
+    summary = {"questions": len(items), "cached": 0, "templated": 0, "failed": 0}
+    write_lock = threading.Lock()
+
+    def emit(index, record, started):
+        # elapsed_seconds is counted from the start of the batch, i.e. when the result became available
+        record = {"index": index, **record, "elapsed_seconds": round(time.perf_counter() - started, 3)}
+        with write_lock:
+            if "error" in record:
+                summary["failed"] += 1
+            write(record)
+
+    def translate(index):
+        item = items[index]
+        handler = handlers[item["database"]]
+        try:
+            response = llm.invoke(handler.translation_prompt(item["question"]))
+        except Exception as e:
+            return None, f"LLM call failed: {e}"
+        record_llm_usage(response, "llm_batch")
+        translation = handler.parse_translation(response.content)
+        return translation, None if translation else "Unexpected output."
+
+    def execute(index, translation, path, started):
+        item = items[index]
+        handler = handlers[item["database"]]
+        try:
+            deadline = Deadline(timeout) if timeout else None
+            output = handler.run_translation(translation, deadline)
+            record = result_record(item, output, max_rows)
+        except Exception as e:
+            record = {"question": item["question"], "database": item["database"], "error": str(e)}
+
+        if path == "template" and "error" in record:
+            # Same as the interactive path: a template that does not run leaves the question to the LLM
+            handler.templates.fallback(item["database"])
+            translation, error = translate(index)
+            if error:
+                emit(index, {"question": item["question"], "database": item["database"], "error": error}, started)
+            else:
+                execute(index, translation, "llm", started)
+            return
+
+        # Same rule as the interactive path: only translations that executed get cached
+        if path == "llm" and "error" not in record:
+            if handler.cache:
+                handler.cache.set(item["database"], item["question"], handler.schema_fingerprint, translation)
+            if handler.templates:
+                handler.templates.learn(item["database"], item["question"], handler.schema_fingerprint, translation)
+        emit(index, {**record, "intent_path": path}, started)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="batch-db") as executor:
+        pending = []
+        for index, item in enumerate(items):
+            handler = handlers[item["database"]]
+            translation = handler.cache.get(item["database"], item["question"], handler.schema_fingerprint) if handler.cache else None
+            if translation:
+                summary["cached"] += 1
+                executor.submit(execute, index, translation, "cache", started)
+                continue
+            translation = handler.templates.match(item["database"], item["question"], handler.schema_fingerprint) if handler.templates else None
+            if translation:
+                summary["templated"] += 1
+                executor.submit(execute, index, translation, "template", started)
+            else:
+                pending.append(index)
+
+        # Transient errors are retried by the executor, only for the items that hit them
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-llm") as llm_pool:
+            translations = {llm_pool.submit(translate, index): index for index in pending}
+            for future in concurrent.futures.as_completed(translations):
+                index = translations[future]
+                item = items[index]
+                translation, error = future.result()
+                if error:
+                    emit(index, {"question": item["question"], "database": item["database"], "error": error}, started)
+                    continue
+                executor.submit(execute, index, translation, "llm", started)
+
+    summary["seconds"] = time.perf_counter() - started
+    return summary
+
+
+def build_handlers(databases, ip, db_workers, rate_limit=None, concurrency=8):
+    from langchain_core.rate_limiters import InMemoryRateLimiter
+    from langchain_openai import ChatOpenAI
+    from query import SQLHandler, MongoHandler
+    from pools import get_http_client
+
+    load_dotenv()
+    rate_limiter = InMemoryRateLimiter(requests_per_second=rate_limit) if rate_limit else None
+    # One keep-alive HTTP pool for all concurrent LLM calls; timeouts, hedging and retries are left to LLMExecutor
+    chat_model = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key=os.getenv("KEY"), rate_limiter=rate_limiter,
+                            base_url=os.getenv("LLM_BASE_URL") or None, http_client=get_http_client(), max_retries=0)
+    llm = LLMExecutor(chat_model, max_concurrency=concurrency)
+
+    # The same guard, caches and templates as the web app (their defaults match main.py's settings), so batch
+    # queries get a LIMIT and the EXPLAIN check, and writes invalidate the results cached by the app
+    translation_cache = TranslationCache(path=os.getenv("TRANSLATION_CACHE_PATH", ".cache/translations.sqlite3") or None)
+    result_cache = ResultCache(path=os.getenv("RESULT_CACHE_PATH", ".cache/result_invalidations.sqlite3") or None)
+    shared = {"cache": translation_cache, "guard": QueryGuard(), "result_cache": result_cache, "templates": TemplateStore(translation_cache)}
+    handlers = {}
+    # The pools only need as many connections as there are database workers
+    if "mysql" in databases:
+        handlers["mysql"] = SQLHandler(llm, ip, count_total=False, pool_options={"pool_size": db_workers, "max_overflow": 0}, **shared)
+    if "mongo" in databases:
+        handlers["mongo"] = MongoHandler(llm, ip, "Books", **shared,
+                                         pool_options={"max_pool_size": db_workers, "min_pool_size": 0},
+                                         schema_cache_path=os.getenv("MONGO_SCHEMA_CACHE_PATH", ".cache/mongo_schema.json") or None)
+    return llm, handlers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of natural language questions and write the results as JSON lines.")
+    parser.add_argument("questions", help="File with one question (or JSON object) per line, - for stdin")
+    parser.add_argument("--database", choices=DATABASES, default="mysql", help="Database for questions that do not name one")
+    parser.add_argument("--output", default="-", help="JSON lines output file, - for stdout")
+    parser.add_argument("--concurrency", type=int, default=8, help="LLM calls in flight at once")
+    parser.add_argument("--db-workers", type=int, default=8, help="Queries executed at once")
+    parser.add_argument("--max-rows", type=int, default=1000, help="Rows written per SELECT result")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds each query may run, 0 for no limit")
+    parser.add_argument("--requests-per-second", type=float, help="Cap on LLM requests per second")
+    parser.add_argument("--ip", default="18.217.76.1", help="Host of the MySQL and MongoDB servers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.questions == "-":
+        items = read_questions(sys.stdin, args.database)
+    else:
+        with open(args.questions) as f:
+            items = read_questions(f, args.database)
+
+    llm, handlers = build_handlers({item["database"] for item in items}, args.ip, args.db_workers, args.requests_per_second,
+                                  args.concurrency)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        def write(record):
+            out.write(to_json(record) + "\n")
+            out.flush()
+
+        summary = run_batch(items, handlers, llm, write, concurrency=args.concurrency, db_workers=args.db_workers,
+                            max_rows=args.max_rows, timeout=args.timeout or None)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"{summary['questions']} questions ({summary['cached']} from the translation cache, {summary['templated']} from templates, "
+          f"{summary['failed']} failed) "
+          f"in {summary['seconds']:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Offline benchmark for the query pipeline.
+
+Runs the SQL and MongoDB handlers against local stand-ins (a SQLite copy of
+the Music schema and a mongomock Books database, or a local MySQL / mongod
+given with --sql-uri / --mongo-uri) with a fake LLM that replays the
+responses recorded in benchmark_responses.json, so no network is needed.
+
+For every result size it reports p50/p95/p99 latency and peak memory of each
+stage (classify, generate, execute, format) plus the overall throughput:
+
+    python benchmark.py --sizes 10,1000,100000,1000000 --iterations 20
+
+With --llm-url the LLM calls go over HTTP through LLMExecutor instead, e.g.
+to fake_llm_server.py started with --responses benchmark_responses.json and
+some injected stragglers, to see what hedging does to the tail latency.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+from tabulate import tabulate
+from cache import normalize_question
+from intent import classify_intent
+from query import SQLHandler, MongoHandler
+from formatting import process_output
+
+STAGES = ["classify", "generate", "execute", "format"]
+
+MUSIC_TABLES = [
+    "CREATE TABLE artists (artist_id INTEGER PRIMARY KEY, name VARCHAR(100))",
+    "CREATE TABLE albums (album_id INTEGER PRIMARY KEY, name VARCHAR(200), artist_id INTEGER, release_year INTEGER)",
+    "CREATE TABLE tracks (track_id INTEGER PRIMARY KEY, name VARCHAR(200), album_id INTEGER, duration_ms INTEGER, popularity INTEGER)",
+    "CREATE TABLE sounds (track_id INTEGER PRIMARY KEY, energy FLOAT, danceability FLOAT, tempo FLOAT)",
+]
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeLLM:
+    """
+    Stand-in for ChatOpenAI that answers from recorded responses, keyed by
+    the normalized instruction found in the prompt. `latency` adds a fixed
+    delay per call to simulate the API round trip.
+    """
+    def __init__(self, responses, latency=0.0):
+        self.responses = responses
+        self.latency = latency
+        self.calls = 0
+
+    def invoke(self, prompt, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeMessage(self.respond(prompt))
+
+    def respond(self, prompt):
+        backend = "mysql" if "MySQL" in prompt else "mongo"
+        questions = re.findall(r"(?:Instruction|Question|User's Query): \"(.*)\"", prompt)
+        recorded = self.responses[backend][normalize_question(questions[-1])]
+
+        # Combined prompts get intent and query, the single-purpose ones only the query
+        if "First classify" in prompt:
+            return json.dumps(recorded)
+        if isinstance(recorded["query"], str):
+            return recorded["query"]
+        return json.dumps(recorded["query"])
+
+
+def seed_music(uri, size):
+    engine = create_engine(uri)
+    rng = random.Random(size)
+    albums = max(size // 10, 1)
+    artists = max(albums // 5, 1)
+
+    with engine.begin() as conn:
+        for table in ["sounds", "tracks", "albums", "artists"]:
+            conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        for ddl in MUSIC_TABLES:
+            conn.execute(text(ddl))
+
+        conn.execute(text("INSERT INTO artists VALUES (:artist_id, :name)"),
+                     [{"artist_id": i, "name": f"Artist {i}"} for i in range(artists)])
+        conn.execute(text("INSERT INTO albums VALUES (:album_id, :name, :artist_id, :release_year)"),
+                     [{"album_id": i, "name": f"Album {i}", "artist_id": i % artists, "release_year": 1960 + i % 60}
+                      for i in range(albums)])
+
+        # Insert in chunks so seeding 1M rows does not build one huge parameter list
+        for start in range(0, size, 50000):
+            ids = range(start, min(start + 50000, size))
+            conn.execute(text("INSERT INTO tracks VALUES (:track_id, :name, :album_id, :duration_ms, :popularity)"),
+                         [{"track_id": i, "name": f"Track {i}", "album_id": i % albums,
+                           "duration_ms": rng.randint(60000, 600000), "popularity": rng.randint(0, 100)} for i in ids])
+            conn.execute(text("INSERT INTO sounds VALUES (:track_id, :energy, :danceability, :tempo)"),
+                         [{"track_id": i, "energy": rng.random(), "danceability": rng.random(),
+                           "tempo": rng.uniform(60, 200)} for i in ids])
+    engine.dispose()
+
+
+def seed_books(db, size):
+    rng = random.Random(size)
+    db.books.drop()
+    db.reviews.drop()
+    for start in range(0, size, 10000):
+        ids = range(start, min(start + 10000, size))
+        db.books.insert_many([
+            {"bookID": str(i), "title": f"Book {i}", "authors": f"Author {i % 500}",
+             "average_rating": round(rng.uniform(1, 5), 2), "ISBN": f"ISBN{i:07d}", "num_pages": rng.randint(50, 1200)}
+            for i in ids
+        ])
+        db.reviews.insert_many([{"bookID": str(i), "rating": rng.randint(1, 5)} for i in ids if i % 2 == 0])
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_question(handler, backend, question, timings=None, memory=None):
+    db_type = "MySQL" if backend == "mysql" else "MongoDB"
+    state = {"start": time.perf_counter()}
+
+    def record(stage):
+        now = time.perf_counter()
+        if timings is not None:
+            timings[stage].append(now - state["start"])
+        if memory is not None:
+            memory[stage] = max(memory[stage], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        state["start"] = time.perf_counter()
+
+    classify_intent(question, backend)
+    record("classify")
+    translation, _ = handler.translate(question)
+    record("generate")
+    output = handler.run_translation(translation)
+    record("execute")
+    process_output(output, db_type, output["intent"])
+    record("format")
+
+    if isinstance(output, dict) and output.get("stream"):
+        output["stream"].close()
+
+
+def bench_handler(handler, backend, questions, iterations):
+    timings = {stage: [] for stage in STAGES}
+    memory = {stage: 0 for stage in STAGES}
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # Warm-up run, then timed runs, then one pass under tracemalloc (which slows everything down)
+        for question in questions:
+            run_question(handler, backend, question)
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for question in questions:
+                run_question(handler, backend, question, timings=timings)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        for question in questions:
+            tracemalloc.reset_peak()
+            run_question(handler, backend, question, memory=memory)
+        tracemalloc.stop()
+
+    return {
+        "throughput": iterations * len(questions) / elapsed,
+        "stages": {
+            stage: {
+                "p50_ms": percentile(timings[stage], 0.50) * 1000,
+                "p95_ms": percentile(timings[stage], 0.95) * 1000,
+                "p99_ms": percentile(timings[stage], 0.99) * 1000,
+                "peak_kib": memory[stage] / 1024,
+            }
+            for stage in STAGES
+        },
+    }
+
+
+def bench_mysql(llm, responses, sizes, iterations, sql_uri=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            uri = sql_uri or f"sqlite:///{os.path.join(directory, f'music_{size}.db')}"
+            print(f"Seeding Music with {size} tracks...", file=sys.stderr)
+            seed_music(uri, size)
+            handler = SQLHandler(llm, "benchmark", db_uri=uri, schema_refresh_interval=None)
+            results[size] = bench_handler(handler, "mysql", list(responses["mysql"]), iterations)
+            handler.engine.dispose()
+    return results
+
+
+def bench_mongo(llm, responses, sizes, iterations, mongo_uri=None):
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            print("mongomock is not installed and no --mongo-uri was given, skipping MongoDB.", file=sys.stderr)
+            return {}
+        client = mongomock.MongoClient()
+
+    results = {}
+    db_name = "BooksBenchmark"
+    for size in sizes:
+        print(f"Seeding Books with {size} books...", file=sys.stderr)
+        seed_books(client[db_name], size)
+        handler = MongoHandler(llm, f"benchmark-{size}", db_name, client=client)
+        results[size] = bench_handler(handler, "mongo", list(responses["mongo"]), iterations)
+    client.drop_database(db_name)
+    return results
+
+
+def report(backend, results):
+    rows = []
+    for size, result in results.items():
+        for stage, stats in result["stages"].items():
+            rows.append([backend, size, stage, stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["peak_kib"]])
+        rows.append([backend, size, "throughput (q/s)", result["throughput"], "", "", ""])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency / memory benchmark of the query pipeline.")
+    parser.add_argument("--sizes", default="10,1000,100000,1000000", help="Rows in the tracks table, comma separated")
+    parser.add_argument("--mongo-sizes", default="10,1000,10000", help="Documents in the books collection, comma separated")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed runs over the question set per size")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds of simulated latency per LLM call")
+    parser.add_argument("--llm-url", help="OpenAI-compatible server to call through LLMExecutor, e.g. http://127.0.0.1:8010/v1")
+    parser.add_argument("--no-hedge", action="store_true", help="With --llm-url, do not send hedged requests")
+    parser.add_argument("--responses", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_responses.json"))
+    parser.add_argument("--sql-uri", help="Use this (local) database instead of SQLite; its Music tables are recreated")
+    parser.add_argument("--mongo-uri", help="Use this (local) mongod instead of mongomock")
+    parser.add_argument("--skip-mysql", action="store_true")
+    parser.add_argument("--skip-mongo", action="store_true")
+    parser.add_argument("--json", help="Also write the raw results to this file")
+    args = parser.parse_args()
+
+    with open(args.responses) as f:
+        responses = json.load(f)
+    llm = FakeLLM(responses, latency=args.llm_latency)
+    if args.llm_url:
+        from langchain_openai import ChatOpenAI
+        from llm_client import LLMExecutor
+        from pools import get_http_client
+        chat_model = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key="benchmark", base_url=args.llm_url,
+                                max_retries=0, http_client=get_http_client())
+        llm = LLMExecutor(chat_model, hedge_percentile=None if args.no_hedge else 0.95)
+
+    results = {}
+    if not args.skip_mysql:
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results["mysql"] = bench_mysql(llm, responses, sizes, args.iterations, args.sql_uri)
+    if not args.skip_mongo:
+        sizes = [int(size) for size in args.mongo_sizes.split(",")]
+        results["mongo"] = bench_mongo(llm, responses, sizes, args.iterations, args.mongo_uri)
+
+    rows = []
+    for backend, backend_results in results.items():
+        rows += report(backend, backend_results)
+    print(tabulate(rows, headers=["backend", "rows", "stage", "p50 ms", "p95 ms", "p99 ms", "peak KiB"],
+                   tablefmt="github", floatfmt=".2f"))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
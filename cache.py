@@ -0,0 +1,367 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+def normalize_question(text):
+    # Lowercase, collapse whitespace and drop trailing punctuation so that
+    # "Show all albums?" and "show  all albums" share a cache entry
+    text = re.sub(r"\s+", " ", str(text).strip().lower())
+    return text.rstrip(" ?.!;")
+
+
+@contextmanager
+def sqlite_connection(path):
+    # A short-lived connection per call keeps the disk backends safe to use
+    # from the worker threads that serve requests
+    conn = sqlite3.connect(path, timeout=5)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def fingerprint(*parts):
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache bounded by entry count (LRU) and age (TTL).
+    A ttl of None keeps entries until they are evicted by size.
+    """
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if self._expired(created):
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, created=None):
+        with self._lock:
+            self._data[key] = (value, created or time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TranslationCache:
+    """
+    Caches natural language -> query translations so that repeated questions
+    skip the LLM. Keys combine the backend, the normalized question and a
+    fingerprint of the schema the translation was generated against.
+
+    If path is given, entries are also written to a small SQLite file so
+    that a restart does not start with a cold cache.
+    """
+    def __init__(self, max_size=1024, ttl=24 * 3600, path=None):
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS translations "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+                )
+                if self.ttl is not None:
+                    conn.execute("DELETE FROM translations WHERE created < ?", (time.time() - self.ttl,))
+
+    def _connect(self):
+        return sqlite_connection(self.path)
+
+    def key(self, namespace, question, schema_fingerprint):
+        return fingerprint(namespace, normalize_question(question), schema_fingerprint)
+
+    def get(self, namespace, question, schema_fingerprint):
+        key = self.key(namespace, question, schema_fingerprint)
+        value = self.memory.get(key)
+
+        if value is None and self.path:
+            # A locked or broken file only costs the hit, it never fails the request
+            try:
+                with self._connect() as conn:
+                    row = conn.execute("SELECT value, created FROM translations WHERE key = ?", (key,)).fetchone()
+                if row and (self.ttl is None or time.time() - row[1] <= self.ttl):
+                    value = json.loads(row[0])
+                    self.memory.set(key, value, created=row[1])
+            except (sqlite3.Error, ValueError) as e:
+                log.warning("Could not read the translation cache: %s", e)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, namespace, question, schema_fingerprint, value):
+        key = self.key(namespace, question, schema_fingerprint)
+        self.memory.set(key, value)
+
+        if not self.path:
+            return
+        # Called after the query already ran (maybe a committed write), so failing to persist is only logged
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO translations (key, value, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, default=str), time.time()),
+                )
+                # Keep the file bounded the same way as the in-memory LRU
+                conn.execute(
+                    "DELETE FROM translations WHERE key NOT IN "
+                    "(SELECT key FROM translations ORDER BY created DESC LIMIT ?)",
+                    (self.max_size,),
+                )
+        except sqlite3.Error as e:
+            log.warning("Could not write the translation cache: %s", e)
+
+    def clear(self):
+        self.memory.clear()
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM translations")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.memory)}
+
+
+def canonical_sql(sql_query):
+    # Collapse whitespace and lowercase everything outside of quoted literals
+    parts = re.split(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""", sql_query.strip().rstrip(";"))
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part).lower()
+        for i, part in enumerate(parts)
+    ).strip()
+
+
+# A table name with an optional alias; keywords right after a table ("tracks JOIN albums") are no alias
+SQL_KEYWORDS = (
+    "join", "straight_join", "inner", "left", "right", "outer", "cross", "natural", "on", "using", "where", "set",
+    "group", "order", "limit", "having", "union", "values", "select", "window", "for", "lock",
+)
+SQL_TABLE = r"[`\w.]+(?:\s+(?:as\s+)?(?!(?:" + "|".join(SQL_KEYWORDS) + r")\b)\w+)?"
+
+
+def referenced_tables(sql_query):
+    """
+    Tables read or written by a SQL statement (FROM, JOIN, INTO, UPDATE
+    targets). None when the statement has a shape this cannot follow, e.g. a
+    derived table inside a comma-separated FROM list or an unknown join
+    keyword, so that its result is not cached and a write through it drops
+    everything cached for the database.
+    """
+    sql_query = canonical_sql(sql_query)
+    structure = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", "''", sql_query)
+    if set(re.findall(r"\b\w*join\b", structure)) - {"join", "straight_join"} or _derived_table_in_list(structure):
+        return None
+
+    tables = set()
+    for match in re.finditer(r"\b(?:from|(?:straight_)?join|into|update)\s+(" + SQL_TABLE + r"(?:\s*,\s*" + SQL_TABLE + r")*)", sql_query):
+        for item in match.group(1).split(","):
+            table = item.strip().split(" ")[0].strip("`")
+            if table:
+                tables.add(table.split(".")[-1].strip("`"))
+    return tables
+
+
+def _derived_table_in_list(sql_query):
+    # "FROM (SELECT ...) s, albums" or "FROM tracks, (SELECT ...) s": the tables after or around the
+    # subquery would be missed
+    if re.search(r"\b(?:from|join)\s+" + SQL_TABLE + r"(?:\s*,\s*" + SQL_TABLE + r")*\s*,\s*\(", sql_query):
+        return True
+    for match in re.finditer(r"\b(?:from|join)\s*\(", sql_query):
+        depth, position = 0, match.end() - 1
+        for position in range(match.end() - 1, len(sql_query)):
+            depth += {"(": 1, ")": -1}.get(sql_query[position], 0)
+            if depth == 0:
+                break
+        if re.match(r"\s*(?:(?:as\s+)?\w+\s*)?,", sql_query[position + 1:]):
+            return True
+    return False
+
+
+def referenced_collections(collection_name, pipeline):
+    """The pipeline's collection plus every collection pulled in by $lookup, $graphLookup and $unionWith."""
+    collections = {collection_name}
+
+    def walk(value):
+        if isinstance(value, dict):
+            for key, inner in value.items():
+                if key in ("$lookup", "$graphLookup") and isinstance(inner, dict) and inner.get("from"):
+                    collections.add(inner["from"])
+                elif key == "$unionWith":
+                    collections.add(inner if isinstance(inner, str) else inner.get("coll"))
+                walk(inner)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item)
+
+    walk(pipeline)
+    collections.discard(None)
+    return collections
+
+
+class ResultCache:
+    """
+    Caches query results keyed by the canonical SQL text or the pipeline, and
+    tagged with the tables/collections the query reads. invalidate() drops
+    every entry that touches one of the written targets.
+
+    Callers read generation() before running a query and pass it to set(),
+    so a result computed while a write was happening is never stored.
+
+    If path is given, invalidations are also appended to a small SQLite log.
+    Every cache using the same file replays the new entries of that log
+    before it answers, so a write made through one process (--workers)
+    drops the results the other processes cached as well. When the log
+    cannot be read, lookups miss rather than risk a stale result.
+    """
+    def __init__(self, max_size=256, ttl=600, path=None):
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.ttl = ttl
+        self.path = path
+        self._tags = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._seen = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with sqlite_connection(self.path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS invalidations "
+                    "(id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, targets TEXT, created REAL NOT NULL)"
+                )
+                # Nothing is cached yet, so earlier invalidations do not matter
+                self._seen = conn.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+
+    def key(self, namespace, query):
+        if isinstance(query, str):
+            query = canonical_sql(query)
+        # Stage and key order matter in pipelines, so no sort_keys here
+        payload = json.dumps([namespace, query], default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _sync(self):
+        # Applies the invalidations other processes logged since the last call, False if the log is unreadable
+        if not self.path:
+            return True
+        try:
+            with sqlite_connection(self.path) as conn:
+                rows = conn.execute(
+                    "SELECT id, namespace, targets FROM invalidations WHERE id > ? ORDER BY id", (self._seen,)
+                ).fetchall()
+        except sqlite3.Error as e:
+            log.warning("Could not read result cache invalidations: %s", e)
+            return False
+        for row_id, namespace, targets in rows:
+            self._invalidate_local(namespace, json.loads(targets) if targets else None)
+            with self._lock:
+                self._seen = max(self._seen, row_id)
+        return True
+
+    def generation(self, namespace):
+        self._sync()
+        with self._lock:
+            return self._generations.get(namespace, 0)
+
+    def get(self, namespace, query):
+        value = self.memory.get(self.key(namespace, query)) if self._sync() else None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, namespace, query, targets, value, generation):
+        if not targets:
+            return
+        key = self.key(namespace, query)
+        if not self._sync():
+            return
+        with self._lock:
+            if self._generations.get(namespace, 0) != generation:
+                return
+            for target in targets:
+                self._tags.setdefault((namespace, target), set()).add(key)
+        self.memory.set(key, value)
+
+    def invalidate(self, namespace, targets=None):
+        self._invalidate_local(namespace, targets)
+        if not self.path:
+            return
+        try:
+            with sqlite_connection(self.path) as conn:
+                conn.execute(
+                    "INSERT INTO invalidations (namespace, targets, created) VALUES (?, ?, ?)",
+                    (namespace, json.dumps(sorted(targets)) if targets else None, time.time()),
+                )
+                # Older entries cannot affect anything still cached
+                if self.ttl is not None:
+                    conn.execute("DELETE FROM invalidations WHERE created < ?", (time.time() - 2 * self.ttl,))
+        except sqlite3.Error as e:
+            log.warning("Could not share result cache invalidation with other processes: %s", e)
+
+    def _invalidate_local(self, namespace, targets):
+        # Without known targets everything cached for the namespace is dropped
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            if targets:
+                tags = [(namespace, target) for target in targets]
+            else:
+                tags = [tag for tag in self._tags if tag[0] == namespace]
+            keys = set()
+            for tag in tags:
+                keys |= self._tags.pop(tag, set())
+        for key in keys:
+            self.memory.delete(key)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.memory)}
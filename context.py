@@ -0,0 +1,20 @@
+class RequestContext:
+    """
+    State of one request, passed to SQLHandler.query() and MongoHandler.query().
+
+    The handlers themselves only hold resources shared by all requests (LLM,
+    engine / client pools, schema and result caches), which are either never
+    mutated after construction or guard their own state with locks. Anything
+    that belongs to a single request lives here instead, so one handler can
+    serve any number of requests at once.
+
+    deadline: Deadline of the request, None for no limit
+    on_token: called with every LLM token as it is generated
+    on_translation: called with the translation before it is executed
+    trace: the metrics.Trace the request's spans are recorded in
+    """
+    def __init__(self, deadline=None, on_token=None, on_translation=None, trace=None):
+        self.deadline = deadline
+        self.on_token = on_token
+        self.on_translation = on_translation
+        self.trace = trace
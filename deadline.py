@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+import pymongo
+from sqlalchemy.sql import text
+
+log = logging.getLogger(__name__)
+
+
+class QueryTimeout(TimeoutError):
+    pass
+
+
+class Deadline:
+    """
+    Per-request time budget. It is created once when a request arrives and
+    passed down so the LLM call, MySQL and MongoDB each only get the time
+    that is actually left instead of their own fixed timeouts.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def remaining_ms(self):
+        return int(self.remaining() * 1000)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise QueryTimeout(f"Query exceeded the {self.seconds}s deadline.")
+
+
+@contextmanager
+def kill_query_on_deadline(engine, connection, deadline):
+    """
+    Runs KILL QUERY for the statement on `connection` from a separate
+    connection once the deadline passes, so MySQL stops working on queries
+    nobody is waiting for anymore.
+    """
+    if deadline is None or engine.dialect.name != "mysql":
+        yield
+        return
+
+    deadline.check()
+    thread_id = connection.connection.dbapi_connection.thread_id()
+    fired = threading.Event()
+
+    def kill():
+        fired.set()
+        try:
+            with engine.connect() as killer:
+                killer.execute(text(f"KILL QUERY {int(thread_id)}"))
+        except Exception as e:
+            log.warning("Could not kill timed out query: %s", e)
+
+    timer = threading.Timer(deadline.remaining(), kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    except Exception as e:
+        if fired.is_set():
+            raise QueryTimeout("The query was killed after exceeding its deadline.") from e
+        raise
+    finally:
+        timer.cancel()
+
+
+def mongo_deadline(deadline):
+    if deadline is None:
+        return nullcontext()
+    # pymongo applies the remaining time as maxTimeMS to every operation in the block
+    deadline.check()
+    return pymongo.timeout(deadline.remaining())
@@ -0,0 +1,31 @@
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+from bson import ObjectId, json_util
+from bson.decimal128 import Decimal128
+
+
+class MongoJSONEncoder(json.JSONEncoder):
+    """
+    Serializes documents straight from the driver to JSON, turning BSON
+    types into readable values (ObjectId -> hex string, datetime -> ISO 8601,
+    Decimal128 -> decimal string) instead of round tripping through repr().
+    """
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, (datetime, date)):
+            return o.isoformat()
+        if isinstance(o, Decimal128):
+            return str(o.to_decimal())
+        if isinstance(o, (Decimal, uuid.UUID)):
+            return str(o)
+        if isinstance(o, bytes):
+            return o.hex()
+        # Remaining BSON types (Regex, Timestamp, Code, ...) use their extended JSON form
+        return json_util.default(o)
+
+
+def to_json(value, indent=None):
+    return json.dumps(value, indent=indent, cls=MongoJSONEncoder)
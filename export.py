@@ -0,0 +1,251 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import time
+from tabulate import tabulate
+from encoders import to_json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+EXPORT_SUFFIXES = {"csv": ".csv", "jsonl": ".jsonl", "parquet": ".parquet"}
+PREVIEW_ROWS = 20
+# Export directories older than this are removed by the next export
+EXPORT_MAX_AGE = 60 * 60
+
+
+class RowChunk(list):
+    """A chunk of row dicts that also carries the column names, so an empty result still gets its header."""
+    def __init__(self, rows, columns):
+        super().__init__(rows)
+        self.columns = columns
+
+
+def available_formats():
+    # Parquet needs pyarrow, which is optional
+    return [name for name in EXPORT_SUFFIXES if name != "parquet" or pq is not None]
+
+
+def unique_columns(columns):
+    # A JOIN can return several columns with the same name (tracks.name, albums.name): name, name_1, ...
+    seen, unique = set(), []
+    for column in columns:
+        name, suffix = column, 0
+        while name in seen:
+            suffix += 1
+            name = f"{column}_{suffix}"
+        seen.add(name)
+        unique.append(name)
+    return unique
+
+
+def remove_old_exports(directory, max_age=EXPORT_MAX_AGE):
+    cutoff = time.time() - max_age
+    for entry in os.scandir(directory):
+        if entry.name.startswith("nlq-export-") and entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def cell(value):
+    # Flat value for CSV / Parquet columns: nested documents and arrays become JSON text,
+    # BSON and SQL types (ObjectId, datetime, Decimal, ...) their JSON string form
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, (dict, list, tuple)):
+        return to_json(value)
+    return json.loads(to_json(value))
+
+
+def write_export(chunks, export_format, directory=None, max_age=EXPORT_MAX_AGE):
+    """
+    Writes chunks (lists of row dicts, as yielded by SQLHandler.export_select()
+    and MongoHandler.export_aggregation()) to a new file one chunk at a time,
+    so memory only depends on the chunk size. CSV and Parquet columns are the
+    columns of a RowChunk, or the fields of the documents in the order they
+    are first seen; JSON lines keep every document as it is.
+
+    Nothing is dropped or converted lossily: a field first seen in a later
+    chunk becomes a new column, and a Parquet column whose values no longer
+    fit its type is widened (integer to double, anything else to text). Both
+    rewrite the file written so far, which only happens when the columns
+    change.
+
+    Every export gets its own directory under `directory` (the system temp
+    directory by default), and exports older than max_age seconds are
+    removed first. Returns the path, number of rows, size and the first
+    PREVIEW_ROWS rows.
+    """
+    if export_format not in available_formats():
+        raise ValueError(f"Unsupported export format '{export_format}', available: {', '.join(available_formats())}.")
+
+    directory = directory or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+    remove_old_exports(directory, max_age)
+    export_directory = tempfile.mkdtemp(prefix="nlq-export-", dir=directory)
+    path = os.path.join(export_directory, "result" + EXPORT_SUFFIXES[export_format])
+    summary = {"path": path, "format": export_format, "rows": 0, "columns": None, "preview": []}
+    try:
+        writer = {"csv": _write_csv, "jsonl": _write_jsonl, "parquet": _write_parquet}[export_format]
+        writer(_counted(chunks, summary), path, summary)
+    except Exception:
+        shutil.rmtree(export_directory, ignore_errors=True)
+        raise
+    summary["bytes"] = os.path.getsize(path)
+    return summary
+
+
+def describe_export(summary):
+    text = f"Exported {summary['rows']} rows as {summary['format'].upper()} ({summary['bytes'] / 1024:.1f} KiB)."
+    if not summary["preview"]:
+        return text
+    columns = summary["columns"] or list(summary["preview"][0])
+    rows = [[cell(row.get(column)) for column in columns] for row in summary["preview"]]
+    return f"{text} First {len(rows)} rows:\n\n" + tabulate(rows, headers=columns, tablefmt="github")
+
+
+def _counted(chunks, summary):
+    for chunk in chunks:
+        if summary["columns"] is None and getattr(chunk, "columns", None):
+            summary["columns"] = list(chunk.columns)
+        if chunk:
+            # Documents do not all have the same fields, new ones are added after the known columns
+            known = set(summary["columns"] or ())
+            summary["columns"] = (summary["columns"] or []) + [column for column in _columns(chunk) if column not in known]
+        if len(summary["preview"]) < PREVIEW_ROWS:
+            summary["preview"] += chunk[:PREVIEW_ROWS - len(summary["preview"])]
+        summary["rows"] += len(chunk)
+        yield chunk
+
+
+def _columns(rows):
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+    return list(columns)
+
+
+def _write_csv(chunks, path, summary):
+    header = None
+    f = open(path, "w", newline="", encoding="utf-8")
+    try:
+        writer = csv.writer(f)
+        for chunk in chunks:
+            columns = summary["columns"]
+            if columns is None:
+                continue
+            if header is None:
+                writer.writerow(columns)
+            elif len(columns) > len(header):
+                f.close()
+                _add_csv_columns(path, columns, len(columns) - len(header))
+                f = open(path, "a", newline="", encoding="utf-8")
+                writer = csv.writer(f)
+            header = list(columns)
+            if chunk:
+                writer.writerows([cell(row.get(column)) for column in columns] for row in chunk)
+    finally:
+        f.close()
+
+
+def _add_csv_columns(path, columns, added):
+    # Rewrites the rows written so far with the new header, the new columns are empty in them
+    rewritten = path + ".part"
+    with open(path, newline="", encoding="utf-8") as source, open(rewritten, "w", newline="", encoding="utf-8") as target:
+        reader, writer = csv.reader(source), csv.writer(target)
+        next(reader)
+        writer.writerow(columns)
+        writer.writerows(row + [""] * added for row in reader)
+    os.replace(rewritten, path)
+
+
+def _write_jsonl(chunks, path, summary):
+    with open(path, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.writelines(to_json(row) + "\n" for row in chunk)
+
+
+def _write_parquet(chunks, path, summary):
+    writer = None
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            current = {field.name: field.type for field in writer.schema} if writer is not None else {}
+            arrays = {
+                column: _column_array([cell(row.get(column)) for row in chunk], current.get(column))
+                for column in summary["columns"]
+            }
+            schema = pa.schema([pa.field(column, array.type) for column, array in arrays.items()])
+            if writer is None:
+                writer = pq.ParquetWriter(path, schema)
+            elif not schema.equals(writer.schema):
+                writer = _widen_parquet(path, writer, schema)
+            writer.write_table(pa.table(arrays, schema=schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # No rows: the columns (if known) are written as text columns
+        pq.write_table(pa.table({column: pa.array([], pa.string()) for column in summary["columns"] or []}), path)
+
+
+def _text_array(values):
+    return pa.array([value if value is None or isinstance(value, str) else json.dumps(value) for value in values], pa.string())
+
+
+def _column_type(current, new):
+    # The narrowest type holding both, all-null columns take whatever comes first
+    if current is None or pa.types.is_null(current):
+        return new
+    if pa.types.is_null(new) or new == current:
+        return current
+    numeric = (pa.types.is_integer, pa.types.is_floating)
+    if any(check(current) for check in numeric) and any(check(new) for check in numeric):
+        return pa.float64()
+    return pa.string()
+
+
+def _column_array(values, current):
+    try:
+        array = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        # Mixed types within the chunk
+        return _text_array(values)
+    try:
+        return array.cast(_column_type(current, array.type), safe=True)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # e.g. an integer too large for a double
+        return _text_array(values)
+
+
+def _widen_parquet(path, writer, schema):
+    # A Parquet file has one schema, so the row groups written so far are rewritten with the wider one
+    writer.close()
+    previous = path + ".part"
+    os.replace(path, previous)
+    try:
+        source = pq.ParquetFile(previous)
+        writer = pq.ParquetWriter(path, schema)
+        for index in range(source.num_row_groups):
+            table = source.read_row_group(index)
+            columns = {}
+            for field in schema:
+                if field.name not in table.column_names:
+                    columns[field.name] = pa.nulls(table.num_rows, field.type)
+                    continue
+                try:
+                    columns[field.name] = table.column(field.name).cast(field.type, safe=True)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                    writer.close()
+                    raise ValueError(f"Column '{field.name}' cannot be stored as {field.type} without changing its values, "
+                                     f"export as JSON lines instead.") from e
+            writer.write_table(pa.table(columns, schema=schema))
+    finally:
+        os.remove(previous)
+    return writer
@@ -0,0 +1,152 @@
+"""
+Local OpenAI-compatible chat completions server with injected latency, for
+testing the LLM execution layer (timeouts, hedging, retries, limits) without
+calling OpenAI:
+
+    python fake_llm_server.py --port 8010 --latency 0.3 --straggler-rate 0.05 --straggler-latency 8
+
+Every response waits `latency` seconds (plus up to `jitter` seconds more);
+`straggler_rate` of them wait `straggler_latency` seconds instead, and
+`error_rate` of them fail with a 500. Point the app at it with
+LLM_BASE_URL=http://127.0.0.1:8010/v1, or run benchmark.py with --llm-url.
+
+With --responses, answers are replayed from benchmark_responses.json like the
+benchmark's FakeLLM does; otherwise every answer is `--reply`.
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from retrieval import count_tokens
+
+log = logging.getLogger(__name__)
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, respond, latency=0.2, jitter=0.1, straggler_rate=0.0, straggler_latency=10.0, error_rate=0.0):
+        super().__init__(address, _CompletionsHandler)
+        self.respond = respond
+        self.latency = latency
+        self.jitter = jitter
+        self.straggler_rate = straggler_rate
+        self.straggler_latency = straggler_latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def delay(self):
+        if random.random() < self.straggler_rate:
+            return self.straggler_latency
+        return self.latency + random.uniform(0, self.jitter)
+
+
+class _CompletionsHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.split("?")[0].rstrip("/") != "/v1/chat/completions":
+            self.send_error(404)
+            return
+        with self.server._lock:
+            self.server.requests += 1
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        time.sleep(self.server.delay())
+        if random.random() < self.server.error_rate:
+            self._send_json(500, {"error": {"message": "Injected failure", "type": "server_error"}})
+            return
+
+        prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+        content = self.server.respond(prompt)
+        usage = {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(content)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": body.get("model", "fake")}
+        try:
+            if body.get("stream"):
+                self._stream(completion, content, usage, (body.get("stream_options") or {}).get("include_usage"))
+            else:
+                self._send_json(200, {
+                    **completion,
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the request, e.g. a hedged duplicate that lost
+            pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, completion, content, usage, include_usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def event(choices, **extra):
+            chunk = {**completion, "object": "chat.completion.chunk", "choices": choices, **extra}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        for piece in [content[i:i + 8] for i in range(0, len(content), 8)]:
+            event([{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}])
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if include_usage:
+            event([], usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        log.debug("fake LLM: " + format, *args)
+
+
+def start_fake_llm_server(respond, port=0, host="127.0.0.1", **latency):
+    # Serves in a background thread; port 0 picks a free port, see server.base_url
+    server = FakeLLMServer((host, port), respond, **latency)
+    threading.Thread(target=server.serve_forever, daemon=True, name="fake-llm").start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible fake LLM server with injected latency.")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before every response")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Up to this many extra seconds, uniformly random")
+    parser.add_argument("--straggler-rate", type=float, default=0.0, help="Share of responses that take --straggler-latency")
+    parser.add_argument("--straggler-latency", type=float, default=10.0, help="Seconds a straggler takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of responses that fail with a 500")
+    parser.add_argument("--responses", help="Replay answers from this file (see benchmark_responses.json)")
+    parser.add_argument("--reply", default="SELECT 1", help="Answer to every prompt without --responses")
+    args = parser.parse_args()
+
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.responses:
+        from benchmark import FakeLLM
+        with open(args.responses) as f:
+            respond = FakeLLM(json.load(f)).respond
+    else:
+        respond = lambda prompt: args.reply
+
+    server = FakeLLMServer((args.host, args.port), respond, latency=args.latency, jitter=args.jitter, straggler_rate=args.straggler_rate,
+                           straggler_latency=args.straggler_latency, error_rate=args.error_rate)
+    log.info("Fake LLM listening on %s", server.base_url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
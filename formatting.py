@@ -0,0 +1,86 @@
+from tabulate import tabulate
+from encoders import to_json
+from guard import describe_decision
+
+# Rendering of handler results for the UI, kept separate from main.py so it can be
+# reused (and benchmarked) without starting the Gradio app
+
+
+def beautify_mongo_query(mongo_query):
+    try:
+        return to_json(mongo_query, indent=1)
+    except Exception as e:
+        return f"Error formatting query: {str(e)}"
+
+
+def format_sql(sql_query, params=None):
+    # SQL from a query template shows the values bound to its placeholders
+    if not params:
+        return sql_query
+    return sql_query + "\n-- " + ", ".join(f":{name} = {value!r}" for name, value in params.items())
+
+
+def beautify_mongo_docs(docs, truncated=False):
+    try:
+        # Documents are serialized straight from the driver's BSON types
+        pretty_json = to_json(docs, indent=1)
+        if truncated:
+            pretty_json += f"\n\nShowing the first {len(docs)} documents, the result was truncated."
+        return pretty_json
+    except Exception as e:
+        return f"Error occurred: {e}"
+
+
+def render_page(rows, columns, start, total_rows, has_more):
+    if isinstance(rows, str):
+        return rows
+    if not rows and start == 1:
+        return "The query returned no rows."
+    pretty_table = tabulate(rows, headers=list(columns), tablefmt='github')
+    end = start + len(rows) - 1
+    if total_rows is not None:
+        indicator = f"Rows {start}-{end} of {total_rows}"
+    else:
+        indicator = f"Rows {start}-{end} of {end}{'+' if has_more else ''}"
+    if has_more:
+        indicator += " (press \"Next Rows\" to load more)"
+    return pretty_table + "\n\n" + indicator
+
+
+def add_guard_note(output, result):
+    # Show what the query guard changed (or why it refused to run the query) under the results
+    decision = result.get("guard")
+    if not decision or decision["action"] == "allow":
+        return output
+    if decision["action"] == "reject":
+        return describe_decision(decision)
+    return output + "\n\n" + describe_decision(decision)
+
+
+def format_translation(translation):
+    # The generated query as shown while it runs, in the same form process_output() shows it afterwards
+    if translation["intent"] == "schema":
+        return "The user requested schema information..."
+    if isinstance(translation["query"], str):
+        return format_sql(translation["query"], translation.get("params"))
+    return beautify_mongo_query(translation["query"])
+
+
+def process_output(result, db_type, query_type):
+    if db_type == "MySQL":
+        if query_type == "select":
+            pretty_table = render_page(result["sql_result"], result.get("columns", []), 1, result.get("total_rows"), result.get("has_more"))
+            pretty_table = add_guard_note(pretty_table, result)
+            return format_sql(result["query"], result.get("params")), pretty_table
+        elif query_type == "modification":
+            output_message = str(result["rows_mod"]) + " rows were affected."
+            return result["query"], output_message
+    elif db_type == "MongoDB":
+        if query_type == "schema":
+            return "The user requested schema information...", result["result"]
+        elif query_type == "query":
+            pretty_json = beautify_mongo_docs(result["output"], result.get("truncated", False))
+            return beautify_mongo_query(result["mongo_query"]), add_guard_note(pretty_json, result)
+        elif query_type == "modification":
+            output_message = str(result["rows_mod"]) + " rows were affected."
+            return beautify_mongo_query(result["mongo_query"]), output_message
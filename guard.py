@@ -0,0 +1,138 @@
+import logging
+import re
+from sqlalchemy.sql import text
+from deadline import kill_query_on_deadline, mongo_deadline
+
+log = logging.getLogger(__name__)
+
+LIMIT_PATTERN = re.compile(r"\blimit\s+(\d+|:\w+)(\s*(,|offset)\s*(\d+|:\w+))?\s*$", re.IGNORECASE)
+BLOCKING_MONGO_STAGES = ("$sort", "$group", "$lookup", "$graphLookup", "$bucket", "$bucketAuto", "$facet")
+
+
+class QueryGuard:
+    """
+    Checks generated queries before they run against the shared databases.
+
+    SQL: adds a LIMIT when the query has none and rejects queries whose
+    EXPLAIN estimates more than max_estimated_rows examined rows or more than
+    max_full_scans full table scans of tables with at least
+    full_scan_min_rows rows.
+
+    MongoDB: appends a $limit stage when the pipeline has none and rejects
+    pipelines that need a COLLSCAN over a collection with more than
+    large_collection_docs documents before any limit can apply.
+
+    Every check returns the (possibly rewritten) query and a decision dict
+    that is passed on in the result so the UI can show it. Exports of the
+    full result pass add_limit=False and only get the EXPLAIN checks, SQL
+    from a query template passes its bind params.
+    """
+    def __init__(self, max_estimated_rows=5_000_000, max_full_scans=2, full_scan_min_rows=1000,
+                 default_limit=10000, large_collection_docs=100_000):
+        self.max_estimated_rows = max_estimated_rows
+        self.max_full_scans = max_full_scans
+        self.full_scan_min_rows = full_scan_min_rows
+        self.default_limit = default_limit
+        self.large_collection_docs = large_collection_docs
+
+    def check_sql(self, engine, sql_query, deadline=None, add_limit=True, params=None):
+        decision = {"action": "allow", "reasons": [], "estimated_rows": None, "full_scans": None}
+        sql_query = sql_query.strip().rstrip(";").strip()
+
+        if not sql_query.lower().startswith(("select", "with")):
+            return sql_query, decision
+
+        if add_limit and not LIMIT_PATTERN.search(sql_query):
+            sql_query = f"{sql_query} LIMIT {self.default_limit}"
+            decision["action"] = "rewrite"
+            decision["reasons"].append(f"Added LIMIT {self.default_limit}.")
+
+        if engine.dialect.name != "mysql":
+            return sql_query, decision
+
+        try:
+            with engine.connect() as connection:
+                with kill_query_on_deadline(engine, connection, deadline):
+                    result = connection.execute(text(f"EXPLAIN {sql_query}"), params or {})
+                    plan = [dict(zip(result.keys(), row)) for row in result.fetchall()]
+        except Exception as e:
+            # Let the query itself report whatever is wrong with it
+            log.warning("Could not EXPLAIN generated SQL: %s", e)
+            return sql_query, decision
+
+        # Rows examined by a nested-loop join multiply within one SELECT, separate SELECTs add up
+        per_select = {}
+        full_scans = 0
+        for step in plan:
+            rows = int(step.get("rows") or 1)
+            per_select[step.get("id")] = per_select.get(step.get("id"), 1) * max(rows, 1)
+            table = str(step.get("table") or "")
+            if step.get("type") == "ALL" and not table.startswith("<") and rows >= self.full_scan_min_rows:
+                full_scans += 1
+        estimated_rows = sum(per_select.values())
+
+        decision["estimated_rows"] = estimated_rows
+        decision["full_scans"] = full_scans
+        if estimated_rows > self.max_estimated_rows:
+            decision["action"] = "reject"
+            decision["reasons"].append(f"Estimated {estimated_rows} rows examined (limit {self.max_estimated_rows}).")
+        if full_scans > self.max_full_scans:
+            decision["action"] = "reject"
+            decision["reasons"].append(f"{full_scans} full table scans (limit {self.max_full_scans}).")
+        return sql_query, decision
+
+    def check_mongo(self, db, collection_name, pipeline, deadline=None, add_limit=True):
+        decision = {"action": "allow", "reasons": [], "collscan": None, "collection_docs": None}
+        stages = [next(iter(stage), None) for stage in pipeline if isinstance(stage, dict)]
+
+        if "$out" in stages or "$merge" in stages:
+            return pipeline, decision
+
+        if add_limit and "$limit" not in stages:
+            pipeline = pipeline + [{"$limit": self.default_limit}]
+            decision["action"] = "rewrite"
+            decision["reasons"].append(f"Added $limit {self.default_limit}.")
+
+        try:
+            with mongo_deadline(deadline):
+                explain = db.command("aggregate", collection_name, pipeline=pipeline, explain=True)
+                collscan = "COLLSCAN" in plan_stages(explain)
+                collection_docs = db[collection_name].estimated_document_count() if collscan else None
+        except Exception as e:
+            log.warning("Could not explain generated pipeline: %s", e)
+            return pipeline, decision
+
+        decision["collscan"] = collscan
+        decision["collection_docs"] = collection_docs
+
+        # A COLLSCAN that is cut short by an early $limit is cheap, one feeding $sort/$group/$lookup is not
+        first_limit = stages.index("$limit") if "$limit" in stages else len(stages)
+        blocking = any(stage in BLOCKING_MONGO_STAGES for stage in stages[:first_limit])
+        if collscan and blocking and collection_docs > self.large_collection_docs:
+            decision["action"] = "reject"
+            decision["reasons"].append(
+                f"Pipeline scans all {collection_docs} documents of '{collection_name}' without an index."
+            )
+        return pipeline, decision
+
+
+def plan_stages(explain):
+    # Collects every "stage" name in an explain document, however deeply it is nested
+    found = set()
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "stage" and isinstance(value, str):
+                found.add(value)
+            else:
+                found |= plan_stages(value)
+    elif isinstance(explain, list):
+        for item in explain:
+            found |= plan_stages(item)
+    return found
+
+
+def describe_decision(decision):
+    if not decision or decision["action"] == "allow":
+        return ""
+    label = "Query rejected" if decision["action"] == "reject" else "Query adjusted"
+    return f"{label} by the query guard: " + " ".join(decision["reasons"])
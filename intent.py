@@ -0,0 +1,59 @@
+import re
+
+# Deterministic intent classification for the obvious cases, so that only
+# ambiguous instructions need the LLM to decide between read / write / schema.
+
+SELECT_WORDS = {
+    "show", "list", "count", "find", "get", "display", "select", "what", "which",
+    "who", "how", "give", "top", "average", "avg", "sum", "total", "return", "fetch",
+}
+MODIFICATION_WORDS = {
+    "insert", "add", "delete", "remove", "update", "change", "modify", "set", "rename",
+    "create", "drop", "alter",
+}
+MODIFICATION_PATTERN = re.compile(r"\b(" + "|".join(sorted(MODIFICATION_WORDS)) + r")\b")
+# A leading modification verb alone is not enough ("Create a list of the top 10 tracks", "Add up the
+# durations"), only these shapes are taken as writes without asking the LLM
+CLEAR_MODIFICATION_PATTERN = re.compile(
+    r"^(insert|add)\b.*\b(into|to)\b"
+    r"|^(delete|remove)\b.*\b(from|where)\b"
+    r"|^(update|change|modify|set)\b.*\b(set|to)\b"
+    r"|^(create|drop|alter)( (a|an|the|new))* (table|collection|index|column|database|view)s?\b"
+    r"|^rename\b.*\bto\b"
+)
+READ_CUES = {
+    "list", "top", "sum", "average", "avg", "total", "count", "most", "least", "many", "much",
+    "up", "per", "each", "highest", "lowest",
+}
+SCHEMA_PATTERN = re.compile(
+    r"\b(schema|collections)\b"
+    r"|\b(what|which) (fields|attributes|keys)\b"
+)
+
+
+def classify_intent(question, backend):
+    """
+    Returns "select"/"modification" for MySQL or "query"/"modification"/"schema"
+    for MongoDB when the instruction is unambiguous, otherwise None so the
+    caller can fall back to the LLM.
+    """
+    words = re.findall(r"[a-z]+", question.lower())
+    if not words:
+        return None
+    first = words[0]
+    text = " ".join(words)
+
+    if backend == "mongo" and SCHEMA_PATTERN.search(text):
+        if first in {"what", "which", "show", "list", "describe", "explain"}:
+            return "schema"
+        return None
+
+    if first in MODIFICATION_WORDS:
+        if CLEAR_MODIFICATION_PATTERN.search(text) and not READ_CUES.intersection(words[1:]):
+            return "modification"
+        return None
+
+    if first in SELECT_WORDS and not MODIFICATION_PATTERN.search(text):
+        return "query" if backend == "mongo" else "select"
+
+    return None
@@ -0,0 +1,316 @@
+import collections
+import concurrent.futures
+import logging
+import queue
+import random
+import threading
+import time
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from deadline import Deadline
+from metrics import LLM_HEDGES, LLM_RETRIES
+from retrieval import count_tokens
+
+log = logging.getLogger(__name__)
+
+# Errors worth another attempt; anything else (bad request, authentication, ...) fails the same way again
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError, TimeoutError)
+
+
+class LLMTimeout(TimeoutError):
+    pass
+
+
+class TokenRateLimiter:
+    """
+    Token bucket shared by all LLM calls of the process, refilled at
+    tokens_per_minute. Calls reserve their estimated tokens up front and
+    settle the difference once the response reports its actual usage.
+    """
+    def __init__(self, tokens_per_minute):
+        self.rate = tokens_per_minute / 60
+        self.capacity = tokens_per_minute
+        self.available = tokens_per_minute
+        self.updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens, timeout=None):
+        # A request larger than the whole bucket waits for a full bucket instead of forever
+        tokens = min(tokens, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self._refill()
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+                if deadline is not None:
+                    if time.monotonic() + wait > deadline:
+                        raise LLMTimeout("The LLM token rate limit leaves no room before the call's timeout.")
+                    wait = min(wait, deadline - time.monotonic())
+                self._condition.wait(wait)
+
+    def settle(self, reserved, used):
+        with self._condition:
+            self._refill()
+            self.available = min(self.capacity, self.available + reserved - used)
+            self._condition.notify_all()
+
+
+class LLMExecutor:
+    """
+    Wraps the chat model the handlers receive and runs every call with:
+
+    - a per-call timeout of call_timeout seconds, or whatever is left of the
+      `timeout` passed by the caller (the request deadline) if that is less;
+    - hedging: when a call has not answered after the hedge_percentile
+      latency of recent calls, an identical request is sent and whichever
+      answers first is used. Streamed calls are hedged the same way on the
+      time to their first token, and the stream that produces one first is
+      kept. Until min_samples calls have been timed, hedge_delay seconds are
+      used instead;
+    - retries with full-jitter exponential backoff on timeouts, connection
+      errors, 5xx and rate limit errors, up to max_attempts per call;
+    - at most max_concurrency requests in flight and, with tokens_per_minute
+      set, a token bucket shared by the whole process.
+
+    Hedged and retried requests count against the concurrency and token
+    limits like any other request. Streamed calls are only retried while no
+    token has been passed on yet. Everything else (with_retry,
+    batch_as_completed, ...) is passed through to the wrapped model.
+    """
+    def __init__(self, llm, call_timeout=20, hedge_percentile=0.95, hedge_delay=5.0, min_hedge_delay=0.5, min_samples=20,
+                 max_attempts=3, backoff=0.5, max_backoff=8, max_concurrency=16, tokens_per_minute=None,
+                 expected_output_tokens=500, latency_window=500):
+        self.llm = llm
+        self.call_timeout = call_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.expected_output_tokens = expected_output_tokens
+
+        self.limiter = TokenRateLimiter(tokens_per_minute) if tokens_per_minute else None
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._in_flight = 0
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._first_token_latencies = collections.deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        # Room for every request in flight plus the hedges waiting for a slot
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * max_concurrency, thread_name_prefix="llm")
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def current_hedge_delay(self, streaming=False):
+        with self._lock:
+            latencies = sorted(self._first_token_latencies if streaming else self._latencies)
+        if not self.hedge_percentile:
+            return None
+        if len(latencies) < self.min_samples:
+            return self.hedge_delay
+        return max(self.min_hedge_delay, latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile))])
+
+    def stats(self):
+        with self._lock:
+            in_flight, samples = self._in_flight, len(self._latencies)
+        return {"in_flight": in_flight, "latency_samples": samples, "hedge_delay": self.current_hedge_delay(),
+                "stream_hedge_delay": self.current_hedge_delay(streaming=True)}
+
+    def invoke(self, prompt, timeout=None, **kwargs):
+        budget = Deadline(timeout) if timeout is not None else None
+        attempt = 1
+        while True:
+            call_timeout = self.call_timeout if budget is None else min(self.call_timeout, budget.remaining())
+            try:
+                return self._hedged(prompt, call_timeout, kwargs)
+            except RETRYABLE_ERRORS as e:
+                self._retry_or_raise(e, attempt, budget)
+            attempt += 1
+
+    def stream(self, prompt, timeout=None, **kwargs):
+        budget = Deadline(timeout) if timeout is not None else None
+        attempt = 1
+        while True:
+            call_timeout = self.call_timeout if budget is None else min(self.call_timeout, budget.remaining())
+            started = False
+            try:
+                for chunk in self._stream_hedged(prompt, call_timeout, kwargs):
+                    started = True
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS as e:
+                # Tokens already shown cannot be taken back
+                if started:
+                    raise
+                self._retry_or_raise(e, attempt, budget)
+            attempt += 1
+
+    def _retry_or_raise(self, error, attempt, budget):
+        if attempt >= self.max_attempts:
+            raise error
+        # Full jitter keeps callers that failed together from retrying together
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if budget is not None and budget.remaining() <= delay:
+            raise error
+        LLM_RETRIES.inc(error=type(error).__name__)
+        log.info("LLM call failed (%s), retrying in %.2fs (attempt %d of %d)", error, delay, attempt + 1, self.max_attempts)
+        time.sleep(delay)
+
+    def _hedged(self, prompt, call_timeout, kwargs):
+        timer = Deadline(call_timeout)
+        first = self._pool.submit(self._call, prompt, timer, kwargs)
+        futures = {first}
+
+        hedge_delay = self.current_hedge_delay()
+        if hedge_delay is not None and hedge_delay < call_timeout:
+            concurrent.futures.wait(futures, timeout=hedge_delay)
+            if not first.done():
+                log.debug("LLM call slower than %.2fs, sending a hedged request", hedge_delay)
+                LLM_HEDGES.inc(result="sent")
+                futures.add(self._pool.submit(self._call, prompt, timer, kwargs))
+
+        error = None
+        while futures:
+            done, futures = concurrent.futures.wait(futures, timeout=timer.remaining(), return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        LLM_HEDGES.inc(result="won")
+                    return future.result()
+                error = future.exception()
+        # Requests still running are abandoned, their HTTP timeout ends them
+        if error is not None and not isinstance(error, LLMTimeout):
+            raise error
+        raise LLMTimeout(f"The LLM did not respond within {call_timeout:.1f}s.")
+
+    def _acquire(self, prompt, timer):
+        if not self._slots.acquire(timeout=timer.remaining()):
+            raise LLMTimeout("No LLM request slot became free before the call's timeout.")
+        reserved = 0
+        try:
+            if self.limiter:
+                reserved = count_tokens(str(prompt)) + self.expected_output_tokens
+                self.limiter.acquire(reserved, timeout=timer.remaining())
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_flight += 1
+        return reserved
+
+    def _release(self, reserved, response, latency, latencies=None):
+        with self._lock:
+            self._in_flight -= 1
+            if latency is not None:
+                (self._latencies if latencies is None else latencies).append(latency)
+        self._slots.release()
+        if self.limiter:
+            usage = getattr(response, "usage_metadata", None) or {}
+            self.limiter.settle(reserved, usage.get("total_tokens", reserved))
+
+    def _call(self, prompt, timer, kwargs):
+        reserved = self._acquire(prompt, timer)
+        started, response, latency = time.monotonic(), None, None
+        try:
+            if timer.expired():
+                raise LLMTimeout("The LLM call's timeout passed while waiting for the rate limit.")
+            response = self.llm.invoke(prompt, timeout=timer.remaining(), **kwargs)
+            latency = time.monotonic() - started
+            return response
+        finally:
+            self._release(reserved, response, latency)
+
+    def _stream_hedged(self, prompt, call_timeout, kwargs):
+        # Attempts run in the pool and put (attempt, kind, value) events on one queue, only the
+        # events of the attempt that produced the first token are passed on
+        timer = Deadline(call_timeout)
+        events = queue.Queue()
+        cancelled = []
+
+        def start():
+            cancelled.append(threading.Event())
+            self._pool.submit(self._stream_into, prompt, timer, kwargs, len(cancelled) - 1, events, cancelled[-1])
+
+        start()
+        hedge_delay = self.current_hedge_delay(streaming=True)
+        hedge_at = timer.remaining() - hedge_delay if hedge_delay is not None and hedge_delay < call_timeout else None
+        winner, finished = None, set()
+        try:
+            while True:
+                wait = timer.remaining()
+                if hedge_at is not None:
+                    wait = max(0.0, wait - hedge_at)
+                try:
+                    attempt, kind, value = events.get(timeout=wait)
+                except queue.Empty:
+                    if hedge_at is None:
+                        raise LLMTimeout(f"The LLM did not respond within {call_timeout:.1f}s.")
+                    log.debug("No LLM token after %.2fs, sending a hedged request", hedge_delay)
+                    LLM_HEDGES.inc(result="sent")
+                    hedge_at = None
+                    start()
+                    continue
+
+                if winner is not None and attempt != winner:
+                    continue
+                if kind == "error":
+                    finished.add(attempt)
+                    # A failure with another attempt still running waits for that one, the rest is
+                    # retried by stream() with backoff
+                    if winner is not None or len(finished) == len(cancelled):
+                        raise value
+                    continue
+                if winner is None:
+                    winner, hedge_at = attempt, None
+                    for other, event in enumerate(cancelled):
+                        if other != winner:
+                            event.set()
+                    if winner:
+                        LLM_HEDGES.inc(result="won")
+                if kind == "done":
+                    return
+                yield value
+        finally:
+            # The caller may stop reading early, nothing is left running for it
+            for event in cancelled:
+                event.set()
+
+    def _stream_into(self, prompt, timer, kwargs, attempt, events, cancelled):
+        try:
+            stream = self._stream_once(prompt, timer, kwargs)
+            try:
+                for chunk in stream:
+                    if cancelled.is_set():
+                        return
+                    events.put((attempt, "chunk", chunk))
+            finally:
+                stream.close()
+            events.put((attempt, "done", None))
+        except Exception as e:
+            events.put((attempt, "error", e))
+
+    def _stream_once(self, prompt, timer, kwargs):
+        reserved = self._acquire(prompt, timer)
+        started, response, first_token = time.monotonic(), None, None
+        try:
+            if timer.expired():
+                raise LLMTimeout("The LLM call's timeout passed while waiting for the rate limit.")
+            for chunk in self.llm.stream(prompt, timeout=timer.remaining(), **kwargs):
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                response = chunk if response is None else response + chunk
+                yield chunk
+        finally:
+            # Streams are hedged on the time to their first token, so that is what is measured
+            self._release(reserved, response, first_token, self._first_token_latencies)
@@ -1,104 +1,334 @@
 from dotenv import load_dotenv
 import os
+import logging
+import time
+import contextvars
+import queue
 from langchain_openai import ChatOpenAI
-from query import SQLHandler, MongoHandler
+from query import SQLHandler, MongoHandler, OpenStreams
+from cache import TranslationCache, ResultCache
+from templates import TemplateStore
 import gradio as gr
 import concurrent.futures
 import traceback
-import pandas as pd
-from tabulate import tabulate
-import json
-import ast
-from bson import ObjectId
+from formatting import process_output, render_page, format_translation, add_guard_note
+from export import write_export, describe_export, available_formats
+from deadline import Deadline
+from pools import warm_up_sql, warm_up_mongo, pool_gauges, get_http_client, get_mongo_client
+from llm_client import LLMExecutor
+from startup import LazyBackend
+from context import RequestContext
+import argparse
+import multiprocessing
+import threading
+from retrieval import load_tokenizer
+from guard import QueryGuard
+from metrics import span, start_trace, finish_trace, start_metrics_server, add_collector, render_gauge, REQUESTS, REQUEST_SECONDS
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger(__name__)
 
 # Load API key from .env
 load_dotenv()
 openai_api_key = os.getenv("KEY")
 
 # Initialize LLM
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key=openai_api_key)
+# stream_usage makes streamed responses report their token usage like invoke() does. Requests go through
+# one shared keep-alive HTTP pool, and retries are left to LLMExecutor (max_retries=0).
+# LLM_BASE_URL points it at another OpenAI-compatible server, e.g. fake_llm_server.py for load tests.
+chat_model = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key=openai_api_key, stream_usage=True, max_retries=0,
+                        base_url=os.getenv("LLM_BASE_URL") or None, http_client=get_http_client())
+
+# Every LLM call gets at most LLM_CALL_TIMEOUT seconds (less when the request deadline is closer), is
+# duplicated once it is slower than the p95 of recent calls, and is retried with jittered backoff on
+# timeouts, connection, 5xx and rate limit errors. At most LLM_MAX_CONCURRENCY requests are in flight,
+# and LLM_TOKENS_PER_MINUTE (0 disables it) keeps the process under the account's token rate limit.
+LLM_CALL_TIMEOUT = 12
+LLM_MAX_ATTEMPTS = 3
+LLM_HEDGE_PERCENTILE = 0.95
+LLM_MAX_CONCURRENCY = 16
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+llm = LLMExecutor(chat_model, call_timeout=LLM_CALL_TIMEOUT, max_attempts=LLM_MAX_ATTEMPTS, hedge_percentile=LLM_HEDGE_PERCENTILE,
+                  max_concurrency=LLM_MAX_CONCURRENCY, tokens_per_minute=LLM_TOKENS_PER_MINUTE or None)
 ip = "18.217.76.1"
 
-# Initialize handlers once
-sql_handler = SQLHandler(llm, ip)
-mongo_handler = MongoHandler(llm, ip, "Books")
+# Cache of natural language -> query translations, persisted to disk so restarts start warm
+TRANSLATION_CACHE_SIZE = 1024
+TRANSLATION_CACHE_TTL = 24 * 60 * 60
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", ".cache/translations.sqlite3")
+translation_cache = TranslationCache(max_size=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL, path=TRANSLATION_CACHE_PATH or None)
+# Questions that only differ in their literal values ("top 10 tracks by Drake" / "by Adele") reuse the
+# query of an earlier one with the new values bound, templates are kept in the translation cache
+query_templates = TemplateStore(translation_cache)
 
-# Timeout duration in seconds
-QUERY_TIMEOUT = 30
+# Results of generated queries, dropped when a modification writes to a table/collection they read
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 10 * 60
+# Invalidations are shared through RESULT_CACHE_PATH, so with --workers a write through one process
+# also drops the results cached by the others
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", ".cache/result_invalidations.sqlite3")
+result_cache = ResultCache(max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, path=RESULT_CACHE_PATH or None)
 
-def beautify_mongo_query(raw_dict_str):
-    try:
-        # Convert string to dict
-        dict_obj = ast.literal_eval(raw_dict_str)
-        # Convert dict to formatted JSON
-        pretty_json = json.dumps(dict_obj, indent=1)
-        return pretty_json
-    except Exception as e:
-        return f"Error formatting query: {str(e)}"
+# SELECT results are streamed; only this many rows are read and rendered per page
+SELECT_PAGE_ROWS = 50
+# Run a COUNT(*) over the query to show the total number of rows next to the preview
+SELECT_COUNT_TOTAL = True
+# After the first page is shown, more rows are streamed into the results in page-sized chunks up to this many
+SELECT_STREAM_ROWS = 500
+# Every unfinished result keeps a MySQL connection for "Next Rows". At most OPEN_STREAMS_MAX are kept (the least
+# recently used is closed first), results idle for STREAM_IDLE_TIMEOUT seconds are closed, and fetching a page
+# may take PAGE_TIMEOUT seconds. Keep OPEN_STREAMS_MAX well below pool_size + max_overflow.
+OPEN_STREAMS_MAX = 8
+STREAM_IDLE_TIMEOUT = 120
+PAGE_TIMEOUT = 10
+open_streams = OpenStreams(max_open=OPEN_STREAMS_MAX, idle_timeout=STREAM_IDLE_TIMEOUT)
+
+# Connection pool settings, one pool per backend shared by all handlers
+MYSQL_POOL_OPTIONS = {"pool_size": 10, "max_overflow": 10, "pool_recycle": 1800, "pool_timeout": 10}
+MONGO_POOL_OPTIONS = {"max_pool_size": 50, "min_pool_size": 5, "max_idle_time_ms": 300000}
+
+# Generated queries are checked before they run: a LIMIT / $limit is added when missing and
+# queries whose EXPLAIN looks too expensive for the shared databases are rejected
+query_guard = QueryGuard(
+    max_estimated_rows=5_000_000,
+    max_full_scans=2,
+    full_scan_min_rows=1000,
+    default_limit=10000,
+    large_collection_docs=100_000,
+)
+
+# Prompts only include the SCHEMA_TOP_K tables/collections that best match the question (BM25 over
+# table, column and field names) plus the ones they join with; None sends the whole schema
+SCHEMA_TOP_K = 5
+
+# Aggregation results are read in batches of MONGO_BATCH_SIZE and capped at MONGO_RESULT_CAP documents
+MONGO_BATCH_SIZE = 500
+MONGO_RESULT_CAP = 1000
+
+# The MongoDB schema is inferred from $sample-ed documents of every collection and kept on disk,
+# so later starts use the stored copy and only resample changed collections in the background
+MONGO_SCHEMA_SAMPLE_SIZE = 200
+MONGO_SCHEMA_REFRESH_INTERVAL = 5 * 60
+MONGO_SCHEMA_CACHE_PATH = os.getenv("MONGO_SCHEMA_CACHE_PATH", ".cache/mongo_schema.json")
 
-def beautify_mongo_docs(doc_string):
+def build_sql_handler():
+    handler = SQLHandler(llm, ip, cache=translation_cache, preview_rows=SELECT_PAGE_ROWS, count_total=SELECT_COUNT_TOTAL, pool_options=MYSQL_POOL_OPTIONS, guard=query_guard, result_cache=result_cache, schema_top_k=SCHEMA_TOP_K,
+                         templates=query_templates)
+    # Open the pool's connections before the first user arrives. A failed attempt stops the handler's
+    # schema refresh, LazyBackend builds a new handler on the next one
     try:
-        # Define ObjectId to mimic bson.ObjectId behavior
-        safe_globals = {"ObjectId": lambda x: ObjectId(x)}
+        warm_up_sql(handler.engine)
+    except Exception:
+        handler.close()
+        raise
+    return handler
 
-        # Step 1: Evaluate the string with ObjectId support
-        docs = eval(doc_string, safe_globals)
+def build_mongo_handler():
+    # The schema may load from MONGO_SCHEMA_CACHE_PATH without contacting the server, so the server
+    # is checked first and a failed attempt leaves no schema refresh behind
+    client = get_mongo_client(f"mongodb://{ip}", **MONGO_POOL_OPTIONS)
+    warm_up_mongo(client)
+    handler = MongoHandler(llm, ip, "Books", client=client, cache=translation_cache, batch_size=MONGO_BATCH_SIZE, result_cap=MONGO_RESULT_CAP, pool_options=MONGO_POOL_OPTIONS, guard=query_guard, result_cache=result_cache,
+                           schema_sample_size=MONGO_SCHEMA_SAMPLE_SIZE, schema_refresh_interval=MONGO_SCHEMA_REFRESH_INTERVAL, schema_cache_path=MONGO_SCHEMA_CACHE_PATH or None, schema_top_k=SCHEMA_TOP_K,
+                           templates=query_templates)
+    return handler
 
-        # Step 2: Convert ObjectId to string
-        def clean(doc):
-            return {
-                k: str(v) if isinstance(v, ObjectId) else v
-                for k, v in doc.items()
-            }
+# Handlers are built in background threads, both backends at once, so the UI starts right away and a
+# slow or unreachable database only affects its own questions. Failed attempts are retried with backoff.
+# They are started by serve(), so importing this module (e.g. in the parent of --workers) connects nowhere.
+sql_backend = LazyBackend("Music DB (MySQL)", build_sql_handler)
+mongo_backend = LazyBackend("Books DB (MongoDB)", build_mongo_handler)
+BACKENDS = {"Music DB (MySQL)": (sql_backend, "MySQL"), "Books DB (MongoDB)": (mongo_backend, "MongoDB")}
 
-        cleaned_docs = [clean(d) for d in docs]
+# Prometheus metrics (per-stage latency, cache hit rates, pool usage) are served on METRICS_PORT,
+# set it to 0 to disable the endpoint. With --workers, worker i serves them on METRICS_PORT + i.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+add_collector(pool_gauges)
+add_collector(lambda: render_gauge("nlq_backend_ready", "1 when the backend's handler is connected and ready.",
+                                   [({"backend": name}, int(backend.state == "ready")) for name, (backend, _) in BACKENDS.items()]))
+add_collector(lambda: render_gauge("nlq_llm_requests_in_flight", "LLM API requests in flight, hedges included.",
+                                   [({}, llm.stats()["in_flight"])])
+              + render_gauge("nlq_llm_hedge_delay_seconds", "Seconds after which an LLM call gets a hedged duplicate.",
+                             [({}, llm.stats()["hedge_delay"] or 0)]))
+add_collector(lambda: render_gauge("nlq_template_hit_ratio", "Share of template lookups answered without the LLM.",
+                                   [({"backend": name}, stats["hit_rate"]) for name, stats in query_templates.stats().items()]))
 
-        # Step 3: Pretty-print as JSON
-        return json.dumps(cleaned_docs, indent=1)
+# Fraction of requests whose per-stage spans are appended to TRACE_EXPORT_PATH as JSON lines
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", ".cache/traces.jsonl")
 
-    except Exception as e:
-        return f"Error occurred: {e}"
-
-def process_output(result, db_type, query_type):
-    if db_type == "MySQL":
-        if query_type == "select":
-            print(result["sql_result"])
-            df = pd.DataFrame(result["sql_result"], columns=result.get("columns", []))
-            pretty_table = tabulate(df, headers='keys', tablefmt='github', showindex=False)
-            print(pretty_table)
-            return result["query"], pretty_table
-        elif query_type == "modification":
-            output_message = str(result["rows_mod"]) + " rows were affected."
-            return result["query"], output_message
-    elif db_type == "MongoDB":
-        if query_type == "schema":
-            return "The user requested schema information...", result["result"]
-        elif query_type == "query":
-            return beautify_mongo_query(str(result["mongo_query"])), beautify_mongo_docs(str(result["output"]))
-        elif query_type == "modification":
-            output_message = str(result["rows_mod"]) + " rows were affected."
-            return str(result["mongo_query"]), output_message
-
-def run_query(natural_language_input, database_type):
+# Timeout duration in seconds
+QUERY_TIMEOUT = 30
+# Full results are exported in chunks of EXPORT_CHUNK_ROWS rows, so memory stays flat whatever the size
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_TIMEOUT = 5 * 60
+# Every export gets its own directory here; exports older than EXPORT_MAX_AGE seconds are removed by the
+# next export, and Gradio's copies of them by its cache cleanup (delete_cache below)
+EXPORT_DIR = os.getenv("EXPORT_DIR", ".cache/exports")
+EXPORT_MAX_AGE = 60 * 60
+# How often the UI checks for new LLM tokens while a query is generated
+STREAM_POLL_INTERVAL = 0.05
+
+# Shared, bounded pool of workers running handler calls. The deadline starts when the request
+# arrives, so work that waited too long for a worker gives up as soon as it starts.
+QUERY_WORKERS = 8
+# Requests Gradio runs at once per process, passed to demo.queue(default_concurrency_limit=...).
+# The handlers keep no per-request state (see context.py), so this can safely be raised; keep it at
+# or below QUERY_WORKERS and the MySQL pool size (pool_size + max_overflow) so requests do not queue twice.
+CONCURRENCY_LIMIT = int(os.getenv("CONCURRENCY_LIMIT", "8"))
+query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+
+def close_stream(page_state):
+    if page_state and page_state.get("stream"):
+        page_state["stream"].close()
+
+def discard_result(future):
+    # Runs when a worker finishes after its request already timed out
+    try:
+        result, _ = future.result()
+    except Exception:
+        return
+    if isinstance(result, dict) and result.get("stream"):
+        result["stream"].close()
+
+def run_query(natural_language_input, database_type, page_state=None):
+    # Generator: Gradio shows every yielded (query, results, page_state, export_target) right away, so the LLM's
+    # tokens, the finished query and the first rows appear as soon as each is available
+    close_stream(page_state)
+    deadline = Deadline(QUERY_TIMEOUT)
+    started = time.perf_counter()
+    outcome = "ok"
+    future = None
+    events = queue.Queue()
+    context = RequestContext(deadline=deadline, on_token=lambda token: events.put(("token", token)),
+                             on_translation=lambda translation: events.put(("translation", translation)),
+                             trace=start_trace("run_query", TRACE_SAMPLE_RATE, database=database_type))
     try:
         def safe_query():
-            if database_type == "Music DB (MySQL)":
-                return sql_handler.query(natural_language_input), "MySQL"
-            elif database_type == "Books DB (MongoDB)":
-                return mongo_handler.query(natural_language_input), "MongoDB"
-            else:
+            if database_type not in BACKENDS:
                 return {"query": "", "sql_result": "Invalid database selection."}, database_type
+            # Waits for a backend that is still starting, but not past the request's deadline
+            backend, db_type = BACKENDS[database_type]
+            handler = backend.get(timeout=deadline.remaining())
+            return handler.query(natural_language_input, context), db_type
+
+        # The deadline is also enforced inside the handlers (LLM timeout, KILL QUERY, maxTimeMS),
+        # so the worker stops shortly after we stop waiting for it
+        # The worker runs in a copy of this context so its spans are recorded in this request's trace
+        future = query_executor.submit(contextvars.copy_context().run, safe_query)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(safe_query)
-            result, db_type = future.result(timeout=QUERY_TIMEOUT)
+        streamed, status = "", "Generating query..."
+        translation = None
+        yield streamed, status, None, None
+        while True:
+            try:
+                received = [events.get(timeout=STREAM_POLL_INTERVAL)]
+            except queue.Empty:
+                if future.done():
+                    break
+                if deadline.expired():
+                    raise concurrent.futures.TimeoutError()
+                continue
+            # A burst of tokens becomes one UI update
+            while not events.empty():
+                received.append(events.get_nowait())
+            for kind, value in received:
+                if kind == "token":
+                    streamed += value
+                else:
+                    translation = value
+                    streamed, status = format_translation(value), "Running query..."
+            yield streamed, status, None, None
+
+        result, db_type = future.result(timeout=deadline.remaining())
+        with span("render"):
             result_query, result_output = process_output(result, db_type, result["intent"])
-            return result_query, result_output
+
+        page_state = None
+        if isinstance(result, dict) and result.get("stream"):
+            open_streams.add(result["stream"])
+            page_state = {
+                "stream": result["stream"],
+                "columns": result["columns"],
+                "total_rows": result.get("total_rows"),
+            }
+        # Reading queries can be exported in full; the export reruns the translation, not the LIMITed query
+        export_target = None
+        if translation and translation["intent"] in ("select", "query"):
+            export_target = {"database": database_type, "translation": translation}
+        yield result_query, result_output, page_state, export_target
+
+        # Keep filling in rows chunk by chunk, the rest is left to the "Next Rows" button
+        if page_state:
+            stream, rows = page_state["stream"], list(result["sql_result"])
+            while not stream.exhausted and len(rows) < SELECT_STREAM_ROWS and not deadline.expired():
+                with span("db_fetch", backend="mysql"):
+                    rows += stream.fetch_page(deadline)
+                output = add_guard_note(render_page(rows, page_state["columns"], 1, page_state["total_rows"], not stream.exhausted), result)
+                yield result_query, output, (page_state if not stream.exhausted else None), export_target
 
     except concurrent.futures.TimeoutError:
-        return "query logic", "Query took too long and was canceled. Try a simpler or more specific question."
+        outcome = "timeout"
+        if future is not None and not future.cancel():
+            future.add_done_callback(discard_result)
+        yield "query logic", "Query took too long and was canceled. Try a simpler or more specific question.", None, None
+    except Exception as e:
+        outcome = "error"
+        log.exception("Query failed")
+        yield "query logic", f"An error occurred: {str(e)}", None, None
+    finally:
+        REQUESTS.inc(database=database_type, outcome=outcome)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, database=database_type)
+        finish_trace(context.trace, TRACE_EXPORT_PATH)
+
+def export_result(export_target, export_format):
+    if not export_target:
+        return "Run a query that reads data first, its full result is exported.", None
+    backend, db_type = BACKENDS[export_target["database"]]
+    deadline = Deadline(EXPORT_TIMEOUT)
+    query = export_target["translation"]["query"]
+    params = export_target["translation"].get("params")
+    try:
+        handler = backend.get(timeout=deadline.remaining())
+        if db_type == "MySQL":
+            chunks = handler.export_select(query, EXPORT_CHUNK_ROWS, deadline, params)
+        else:
+            chunks = handler.export_aggregation(query, EXPORT_CHUNK_ROWS, deadline)
+        with span("export", format=export_format):
+            export = write_export(chunks, export_format, EXPORT_DIR, EXPORT_MAX_AGE)
+    except Exception as e:
+        log.exception("Export failed")
+        return f"Export failed: {str(e)}", None
+    return describe_export(export), export["path"]
+
+def backend_status():
+    lines = []
+    for name, (backend, _) in BACKENDS.items():
+        status = backend.status()
+        if status["state"] == "ready":
+            lines.append(f"🟢 {name}: ready")
+        elif status["state"] == "starting":
+            lines.append(f"🟡 {name}: connecting...")
+        else:
+            lines.append(f"🔴 {name}: unavailable, retrying ({status['error']})")
+    return "<p style='text-align: center;'>" + " &nbsp; ".join(lines) + "</p>"
+
+def next_page(page_state):
+    if not page_state or not page_state.get("stream"):
+        return "No more rows to show.", None
+    stream = page_state["stream"]
+    if stream.closed_reason:
+        return f"This result was closed to free its database connection ({stream.closed_reason}). Run the query again to see more rows.", None
+    open_streams.touch(stream)
+    try:
+        start = stream.rows_fetched + 1
+        with span("db_fetch", backend="mysql"):
+            rows = stream.fetch_page(Deadline(PAGE_TIMEOUT))
+        output = render_page(rows, page_state["columns"], start, page_state["total_rows"], not stream.exhausted)
     except Exception as e:
-        return "query logic", f"An error occurred: {str(e)}"
+        stream.close()
+        return f"An error occurred: {str(e)}", None
+    return output, (page_state if not stream.exhausted else None)
 
 custom_css = """
 footer {visibility: hidden}
@@ -109,9 +339,12 @@ footer {visibility: hidden}
 }
 """
 
-with gr.Blocks(title="Natural Language Database Query", css=custom_css) as demo:
+with gr.Blocks(title="Natural Language Database Query", css=custom_css, delete_cache=(EXPORT_MAX_AGE, EXPORT_MAX_AGE)) as demo:
     gr.Markdown("<h1 style='text-align: center;'>Natural Language Database Query</h1>")
     gr.Markdown("<p style='text-align: center;'>Enter a question and choose which database to query from.</p>")
+    # Readiness of each database, refreshed while the app runs
+    status = gr.Markdown(backend_status())
+    gr.Timer(2).tick(fn=backend_status, outputs=status)
 
     with gr.Row(elem_id="input-row"):
         with gr.Column(scale=1):
@@ -119,14 +352,68 @@ with gr.Blocks(title="Natural Language Database Query", css=custom_css) as demo:
             db_choice = gr.Dropdown(choices=["Music DB (MySQL)", "Books DB (MongoDB)"], label="Select Database")
             run_button = gr.Button("Run Query", elem_id="run-button")
 
+    # Holds the open server-side cursor of the current SELECT between "Next Rows" clicks
+    page_state = gr.State(None, time_to_live=15 * 60, delete_callback=close_stream)
+
     with gr.Row(elem_id="output-row"):
         generated_query = gr.Code(label="Generated Query")
         results = gr.Code(label="Results")
 
+    next_button = gr.Button("Next Rows")
+
+    # The translation of the last reading query, rerun without the preview LIMIT when exporting
+    export_target = gr.State(None)
+    with gr.Row(elem_id="export-row"):
+        export_format = gr.Radio(choices=available_formats(), value="csv", label="Export Format")
+        export_button = gr.Button("Export Full Result")
+        export_file = gr.File(label="Download")
+
     run_button.click(
         fn=run_query,
-        inputs=[user_input, db_choice],
-        outputs=[generated_query, results]
+        inputs=[user_input, db_choice, page_state],
+        outputs=[generated_query, results, page_state, export_target]
+    )
+    next_button.click(
+        fn=next_page,
+        inputs=[page_state],
+        outputs=[results, page_state]
     )
+    export_button.click(
+        fn=export_result,
+        inputs=[export_target, export_format],
+        outputs=[results, export_file]
+    )
+
+
+def serve(port, metrics_port=METRICS_PORT):
+    sql_backend.start()
+    mongo_backend.start()
+    # The tokenizer may have to be downloaded; prompts use the token estimate until it is loaded
+    threading.Thread(target=load_tokenizer, daemon=True, name="load-tokenizer").start()
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT).launch(server_port=port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Natural language database query app.")
+    parser.add_argument("--port", type=int, default=7860, help="Port of the (first) Gradio server")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Serve from this many processes on consecutive ports, each with its own pools")
+    args = parser.parse_args()
 
-demo.launch()
\ No newline at end of file
+    if args.workers <= 1:
+        serve(args.port)
+    else:
+        # One Gradio server per process on ports port .. port + workers - 1, to be put behind a load
+        # balancer with sticky sessions (a "Next Rows" click must reach the process holding the cursor).
+        # spawn gives each worker a fresh interpreter instead of forking the parent's threads.
+        spawn = multiprocessing.get_context("spawn")
+        workers = [
+            spawn.Process(target=serve, args=(args.port + i, METRICS_PORT + i if METRICS_PORT else 0), name=f"worker-{i}")
+            for i in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
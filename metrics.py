@@ -0,0 +1,210 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            # One slot per bucket plus a final one for values above the largest bucket
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {sum(counts)}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {sum(counts)}")
+        return lines
+
+
+# Metrics recorded across the handlers and main.py
+STAGE_SECONDS = Histogram("nlq_stage_seconds", "Time spent in each stage of a request.")
+REQUEST_SECONDS = Histogram("nlq_request_seconds", "End-to-end time of a request.")
+ROWS_RETURNED = Histogram("nlq_rows_returned", "Rows or documents returned to the UI per query.", ROW_BUCKETS)
+LLM_TOKENS = Counter("nlq_llm_tokens_total", "LLM tokens used, by kind (input/output).")
+LLM_CALLS = Counter("nlq_llm_calls_total", "LLM calls, by stage.")
+LLM_RETRIES = Counter("nlq_llm_retries_total", "LLM requests retried, by error.")
+LLM_HEDGES = Counter("nlq_llm_hedges_total", "Hedged duplicate LLM requests, by result (sent/won).")
+CACHE_REQUESTS = Counter("nlq_cache_requests_total", "Cache lookups, by cache and result (hit/miss).")
+INTENT_PATHS = Counter("nlq_intent_path_total", "How the intent of a question was determined (local/llm/cache).")
+REQUESTS = Counter("nlq_requests_total", "Requests, by backend and outcome.")
+SCHEMA_PROMPT_TOKENS = Histogram("nlq_schema_prompt_tokens", "Tokens of schema context put into a prompt.", TOKEN_BUCKETS)
+TEMPLATE_REQUESTS = Counter("nlq_template_requests_total", "Query template lookups and updates, by result (hit/miss/learned/fallback).")
+
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS, ROWS_RETURNED, LLM_TOKENS, LLM_CALLS, LLM_RETRIES, LLM_HEDGES, CACHE_REQUESTS, INTENT_PATHS, REQUESTS, SCHEMA_PROMPT_TOKENS, TEMPLATE_REQUESTS]
+
+
+def render_gauge(name, description, samples):
+    # Exposition lines for a gauge read at scrape time, samples are (labels, value) pairs
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{_format_labels(_label_key(labels))} {value}")
+    return lines
+
+
+# Extra callables returning exposition lines, e.g. connection pool gauges
+COLLECTORS = []
+
+
+def add_collector(collector):
+    COLLECTORS.append(collector)
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for collector in COLLECTORS:
+        try:
+            lines += collector()
+        except Exception as e:
+            log.warning("Metrics collector failed: %s", e)
+    return "\n".join(lines) + "\n"
+
+
+# Per-request trace, carried in a context variable so spans recorded in worker threads end up in it
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_export_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, name, sampled, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.sampled = sampled
+        self.attributes = attributes
+        self.started = time.time()
+        self.spans = []
+
+    def as_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": self.started,
+            "attributes": self.attributes,
+            "spans": self.spans,
+        }
+
+
+def start_trace(name, sample_rate=0.0, **attributes):
+    trace = Trace(name, random.random() < sample_rate, **attributes)
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace, export_path=None):
+    if trace is None or not trace.sampled or not export_path:
+        return
+    os.makedirs(os.path.dirname(export_path) or ".", exist_ok=True)
+    with _export_lock, open(export_path, "a") as f:
+        f.write(json.dumps(trace.as_dict(), default=str) + "\n")
+
+
+@contextmanager
+def span(stage, **labels):
+    # Times one stage into nlq_stage_seconds and, for sampled requests, into the request's trace
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage, **labels)
+        trace = _current_trace.get()
+        if trace is not None and trace.sampled:
+            trace.spans.append({"stage": stage, "labels": labels, "offset": time.time() - trace.started - elapsed, "seconds": elapsed})
+
+
+def record_llm_usage(response, stage):
+    LLM_CALLS.inc(stage=stage)
+    # langchain exposes token counts on AIMessage.usage_metadata
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage:
+        LLM_TOKENS.inc(usage.get("input_tokens", 0), kind="input", stage=stage)
+        LLM_TOKENS.inc(usage.get("output_tokens", 0), kind="output", stage=stage)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    log.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,179 @@
+import threading
+import concurrent.futures
+import httpx
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from metrics import render_gauge
+
+# One engine / client per URI, shared by every handler talking to that backend
+_sql_engines = {}
+_mongo_clients = {}
+_mongo_stats = {}
+_http_client = None
+_lock = threading.Lock()
+
+
+class MongoPoolStats(ConnectionPoolListener):
+    """Counts connection pool events reported by pymongo, used by pool_stats()."""
+    def __init__(self):
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failed = 0
+        self._lock = threading.Lock()
+
+    def _add(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def connection_created(self, event):
+        self._add("created")
+
+    def connection_closed(self, event):
+        self._add("closed")
+
+    def connection_checked_out(self, event):
+        self._add("checked_out")
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failed")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def as_dict(self):
+        return {
+            "open": self.created - self.closed,
+            "checked_out": self.checked_out,
+            "checkout_failed": self.checkout_failed,
+        }
+
+
+def get_sql_engine(uri, pool_size=5, max_overflow=10, pool_recycle=1800, pool_timeout=10):
+    """
+    Returns the shared engine for `uri`. Connections are checked with a ping
+    before use and recycled before MySQL's idle timeout closes them, which
+    avoids stale-connection errors after quiet periods. Every paged SELECT
+    result holds one connection until it is read to the end, so size the pool
+    for concurrent users plus open result pages.
+    """
+    with _lock:
+        if uri not in _sql_engines:
+            if make_url(uri).get_backend_name() == "sqlite":
+                # SQLite (used for local benchmarks) has its own pooling rules
+                _sql_engines[uri] = create_engine(uri)
+            else:
+                _sql_engines[uri] = create_engine(
+                    uri,
+                    pool_size=pool_size,
+                    max_overflow=max_overflow,
+                    pool_pre_ping=True,
+                    pool_recycle=pool_recycle,
+                    pool_timeout=pool_timeout,
+                )
+        return _sql_engines[uri]
+
+
+def get_mongo_client(uri, max_pool_size=50, min_pool_size=5, max_idle_time_ms=300000):
+    with _lock:
+        if uri not in _mongo_clients:
+            stats = MongoPoolStats()
+            client = MongoClient(
+                uri,
+                maxPoolSize=max_pool_size,
+                minPoolSize=min_pool_size,
+                maxIdleTimeMS=max_idle_time_ms,
+                event_listeners=[stats],
+            )
+            _mongo_clients[uri] = client
+            _mongo_stats[uri] = stats
+        return _mongo_clients[uri]
+
+
+def get_http_client(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60):
+    """
+    Returns the process-wide HTTP client for LLM API calls. Keeping the
+    connections alive saves the TCP/TLS handshake on every request, and hedged
+    duplicates of a request reuse an idle connection instead of opening one.
+    The limits only apply to the first call, which creates the client.
+    """
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ))
+        return _http_client
+
+
+def warm_up_sql(engine, connections=None):
+    # Open the pool's connections concurrently so the first users don't pay the connection setup
+    connections = connections or (engine.pool.size() if hasattr(engine.pool, "size") else 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        opened = list(executor.map(lambda _: engine.connect(), range(connections)))
+    for connection in opened:
+        connection.close()
+
+
+def warm_up_mongo(client):
+    # minPoolSize makes pymongo keep connections open in the background once the server is known
+    client.admin.command("ping")
+
+
+def pool_stats():
+    stats = {"mysql": {}, "mongo": {}}
+    with _lock:
+        engines = dict(_sql_engines)
+        mongo_stats = dict(_mongo_stats)
+
+    for uri, engine in engines.items():
+        name = make_url(uri).render_as_string(hide_password=True)
+        pool = engine.pool
+        if hasattr(pool, "checkedout"):
+            stats["mysql"][name] = {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+            }
+        else:
+            stats["mysql"][name] = {"status": pool.status()}
+
+    for uri, listener in mongo_stats.items():
+        stats["mongo"][uri] = listener.as_dict()
+    return stats
+
+
+def pool_gauges():
+    # Connection pool usage as Prometheus gauges, registered with metrics.add_collector()
+    stats = pool_stats()
+    checked_out = [({"backend": "mysql", "pool": name}, pool["checked_out"])
+                   for name, pool in stats["mysql"].items() if "checked_out" in pool]
+    checked_out += [({"backend": "mongo", "pool": uri}, pool["checked_out"]) for uri, pool in stats["mongo"].items()]
+    idle = [({"backend": "mysql", "pool": name}, pool["checked_in"])
+            for name, pool in stats["mysql"].items() if "checked_in" in pool]
+    idle += [({"backend": "mongo", "pool": uri}, pool["open"] - pool["checked_out"]) for uri, pool in stats["mongo"].items()]
+    return (render_gauge("nlq_pool_connections_in_use", "Connections checked out of each pool.", checked_out)
+            + render_gauge("nlq_pool_connections_idle", "Idle connections in each pool.", idle))
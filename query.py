@@ -1,16 +1,197 @@
-from langchain_community.utilities import SQLDatabase
-from langchain.callbacks.base import BaseCallbackHandler
-from sqlalchemy import create_engine
+import logging
 import re
-from pymongo import MongoClient
 import json
+import copy
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
 from sqlalchemy.sql import text
 import requests
 import urllib.parse
+from pymongo.errors import PyMongoError
+from cache import referenced_tables, referenced_collections
+from intent import classify_intent
+from schema import SQLSchemaCache, MongoSchemaCache
+from deadline import QueryTimeout, kill_query_on_deadline, mongo_deadline
+from context import RequestContext
+from pools import get_sql_engine, get_mongo_client
+from guard import describe_decision
+from export import RowChunk, unique_columns
+from metrics import span, record_llm_usage, CACHE_REQUESTS, INTENT_PATHS, ROWS_RETURNED, SCHEMA_PROMPT_TOKENS
+from retrieval import count_tokens
+
+log = logging.getLogger(__name__)
+
+
+def parse_json_response(response_text):
+    # Clean potential markdown formatting (```json ... ```) and parse, None if the LLM returned invalid JSON
+    response_text = re.sub(r"^```(?:json)?|```$", "", response_text.strip(), flags=re.MULTILINE).strip()
+    try:
+        return json.loads(response_text)
+    except json.JSONDecodeError:
+        log.warning("LLM did not return a valid JSON response.")
+        log.warning("Invalid JSON: %s", response_text)
+        return None
+
+
+def invoke_llm(llm, prompt, deadline=None, stage="llm_generate", on_token=None):
+    # The OpenAI client only gets the time that is left of the request's budget
+    kwargs = {} if deadline is None else {"timeout": deadline.remaining()}
+    with span(stage):
+        if deadline is not None:
+            deadline.check()
+        try:
+            if on_token is None:
+                response = llm.invoke(prompt, **kwargs)
+            else:
+                # Tokens are passed to on_token as they arrive, the chunks add up to the complete message
+                response = None
+                for chunk in llm.stream(prompt, **kwargs):
+                    on_token(chunk.content)
+                    response = chunk if response is None else response + chunk
+        except Exception as e:
+            if deadline is not None and deadline.expired():
+                raise QueryTimeout("The LLM did not respond before the query deadline.") from e
+            raise
+    if response is None:
+        return ""
+    record_llm_usage(response, stage)
+    return response.content if hasattr(response, "content") else str(response)
+
+
+def report_schema_context(backend, context, selected, total):
+    tokens = count_tokens(context)
+    SCHEMA_PROMPT_TOKENS.observe(tokens, backend=backend)
+    log.info("Schema context: %d of %d %s, %d tokens", selected, total, "tables" if backend == "mysql" else "collections", tokens)
+
+
+class SelectResultStream:
+    """
+    Reads a SELECT result through a server-side cursor (SSCursor with pymysql)
+    one page at a time, so memory stays constant whatever the result size.
+    The connection is held until the last page is read or close() is called.
+    """
+    def __init__(self, engine, sql_query, page_size=50, deadline=None, params=None):
+        self.engine = engine
+        self.page_size = page_size
+        self.rows_fetched = 0
+        self.exhausted = False
+        self.closed_reason = None
+        self._buffer = []
+        self._drained = False
+        # fetch_page() and close() may be called from different threads, e.g. by OpenStreams
+        self._lock = threading.RLock()
+
+        self.connection = engine.connect().execution_options(stream_results=True)
+        try:
+            with kill_query_on_deadline(engine, self.connection, deadline):
+                self.result = self.connection.execute(text(sql_query), params or {})
+        except Exception:
+            self.connection.close()
+            raise
+
+        self.returns_rows = self.result.returns_rows
+        if self.returns_rows:
+            self.columns = list(self.result.keys())
+        else:
+            self.columns = []
+            self.rowcount = self.result.rowcount
+            self.connection.commit()
+            self.close()
+
+    def fetch_page(self, deadline=None):
+        with self._lock:
+            return self._fetch_page(deadline)
+
+    def _fetch_page(self, deadline):
+        if self.exhausted:
+            return []
+
+        # Read one row past the page so we know whether another page exists
+        wanted = self.page_size + 1 - len(self._buffer)
+        try:
+            with kill_query_on_deadline(self.engine, self.connection, deadline):
+                fetched = self.result.fetchmany(wanted)
+        except Exception:
+            self.close()
+            raise
+        self._drained = len(fetched) < wanted
+        rows = self._buffer + fetched
+        page, self._buffer = rows[:self.page_size], rows[self.page_size:]
+        self.rows_fetched += len(page)
+
+        if not self._buffer:
+            self.close()
+        return page
+
+    def close(self, reason=None):
+        with self._lock:
+            if self.exhausted:
+                return
+            if self.returns_rows and not self._drained:
+                # Closing an unfinished server-side cursor would drain every remaining row,
+                # dropping the connection is much cheaper
+                self.connection.invalidate()
+            self.connection.close()
+            self.exhausted = True
+            self.closed_reason = reason
+
+
+class OpenStreams:
+    """
+    Bounds the unfinished SELECT results kept for "Next Rows", each of which
+    holds a pooled connection. At most max_open are kept open: adding one
+    more closes the least recently used. Results nobody paged through for
+    idle_timeout seconds are closed by a background thread.
+    """
+    def __init__(self, max_open=8, idle_timeout=120):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def add(self, stream):
+        with self._lock:
+            self._streams[stream] = time.monotonic()
+            evicted = []
+            while len(self._streams) > self.max_open:
+                evicted.append(self._streams.popitem(last=False)[0])
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, daemon=True, name="open-streams")
+                self._sweeper.start()
+        for oldest in evicted:
+            oldest.close(reason="too many open results")
+
+    def touch(self, stream):
+        with self._lock:
+            if stream in self._streams:
+                self._streams[stream] = time.monotonic()
+                self._streams.move_to_end(stream)
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            finished = [stream for stream, used in self._streams.items() if stream.exhausted or used < cutoff]
+            for stream in finished:
+                del self._streams[stream]
+        for stream in finished:
+            stream.close(reason="idle")
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            self.sweep()
+
+    def __len__(self):
+        return len(self._streams)
+
 
 ## SQL HANDLER
-class SQLHandler(BaseCallbackHandler):
-    def __init__(self, llm, ip):
+class SQLHandler:
+    def __init__(self, llm, ip, cache=None, schema_refresh_interval=60, preview_rows=50, count_total=True, pool_options=None, guard=None, result_cache=None, db_uri=None,
+                 schema_top_k=None, embedder=None, templates=None):
         self.ip = ip
         DB_USER = "test"
         DB_PASSWORD = "test"
@@ -18,54 +199,197 @@ class SQLHandler(BaseCallbackHandler):
         DB_PORT = "3306"
         DB_NAME = "Music"
 
-        self.db_uri = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-        self.engine = create_engine(self.db_uri)
-        self.db = SQLDatabase.from_uri(self.db_uri)
+        # db_uri overrides the MySQL server, e.g. a local SQLite copy of the schema for benchmarks
+        self.db_uri = db_uri or f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+        # Engines are shared per URI, see pools.py for the pool settings
+        self.engine = get_sql_engine(self.db_uri, **(pool_options or {}))
+        # Table info is introspected once and refreshed in the background when the schema changes
+        self.schema = SQLSchemaCache(self.engine, refresh_interval=schema_refresh_interval, embedder=embedder)
+        # With schema_top_k set, prompts only get the top_k tables matching the question and the tables they join with
+        self.schema_top_k = schema_top_k
         self.llm = llm
+        self.cache = cache
+        # Optional TemplateStore, questions that only differ in literals from an earlier one reuse its query
+        self.templates = templates
+
+        # SELECT results are streamed, only preview_rows are read up front
+        self.preview_rows = preview_rows
+        self.count_total = count_total
+
+        # Optional QueryGuard that checks generated SELECTs with EXPLAIN before they run
+        self.guard = guard
+
+        # Optional ResultCache shared with other handlers, entries are tagged with the tables they read
+        self.result_cache = result_cache
+        self.cache_namespace = self.engine.url.render_as_string(hide_password=True)
+
+    def close(self):
+        # The engine is shared through pools.py and stays open, only the schema refresh is stopped
+        self.schema.close()
+
+    @property
+    def schema_fingerprint(self):
+        # Translations are only reused while the schema they were generated against is unchanged
+        return self.schema.fingerprint
+
+    def schema_context(self, question):
+        if not self.schema_top_k or len(self.schema.tables) <= self.schema_top_k:
+            context = self.schema.get_table_info()
+            report_schema_context("mysql", context, len(self.schema.tables), len(self.schema.tables))
+            return context
+
+        tables = self.schema.relevant_tables(question, self.schema_top_k)
+        context = self.schema.get_table_info(tables)
+        others = [name for name in self.schema.tables if name not in tables]
+        if others:
+            context += "\n\nOther tables in the database (columns not shown): " + ", ".join(others)
+        report_schema_context("mysql", context, len(tables), len(self.schema.tables))
+        return context
+
+    def query(self, query, context=None):
+        context = context or RequestContext()
+        deadline = context.deadline
+
+        # Repeated questions are answered from the translation cache without calling the LLM
+        translation = self.cache.get("mysql", query, self.schema_fingerprint) if self.cache else None
+        if self.cache:
+            CACHE_REQUESTS.inc(cache="translation", result="hit" if translation else "miss")
+        if translation:
+            log.debug("Translation cache hit: %s", translation["intent"])
+            INTENT_PATHS.inc(backend="mysql", path="cache")
+            if context.on_translation:
+                context.on_translation(translation)
+            output = self.run_translation(translation, deadline)
+            if isinstance(output, dict):
+                output.update({"cache": "hit", "intent_path": "cache", "llm_calls": 0})
+            return output
+
+        output = self.run_template(query, context)
+        if output is not None:
+            return output
 
-        self.sql_result = []
+        translation, path = self.translate(query, deadline, context.on_token)
+        INTENT_PATHS.inc(backend="mysql", path=path)
+        if not translation:
+            return "Unexpected output."
+
+        # The generated query can be shown while it runs
+        if context.on_translation:
+            context.on_translation(translation)
+        output = self.run_translation(translation, deadline)
+
+        if isinstance(output, dict):
+            output.update({"intent_path": path, "llm_calls": 1})
+            # Only cache translations that executed successfully
+            if (output.get("guard") or {}).get("action") != "reject":
+                if self.cache:
+                    self.cache.set("mysql", query, self.schema_fingerprint, translation)
+                    output["cache"] = "miss"
+                if self.templates:
+                    self.templates.learn("mysql", query, self.schema_fingerprint, translation)
+        return output
+
+    def run_template(self, query, context):
+        # A query template bound to the question's literals, None when there is none or it does not run
+        translation = self.templates.match("mysql", query, self.schema_fingerprint) if self.templates else None
+        if not translation:
+            return None
+        log.debug("Query template hit: %s", translation["params"])
+        INTENT_PATHS.inc(backend="mysql", path="template")
+        if context.on_translation:
+            context.on_translation(translation)
+        try:
+            output = self.run_translation(translation, context.deadline)
+        except QueryTimeout:
+            raise
+        except Exception as e:
+            log.warning("Query template failed, asking the LLM: %s", e)
+            output = None
+        if not isinstance(output, dict) or (output.get("guard") or {}).get("action") == "reject":
+            self.templates.fallback("mysql")
+            return None
+        output.update({"intent_path": "template", "llm_calls": 0})
+        return output
+
+    def translate(self, query, deadline=None, on_token=None):
+        # Obvious instructions are classified locally and go straight to generation,
+        # everything else gets its intent and SQL from a single LLM call
+        with span("classify", backend="mysql"):
+            intent = classify_intent(query, "mysql")
+        if intent == "select":
+            sql_query = self.generate_select_query(query, deadline, on_token)
+        elif intent == "modification":
+            sql_query = self.generate_modification_query(query, deadline, on_token)
+        else:
+            return self.generate_translation(query, deadline, on_token), "llm"
 
-    def on_agent_action(self, action, **kwargs):
-        if action.tool in ["sql_db_query_checker", "sql_db_query"]:
-            self.sql_result.append(action.tool_input)
-    
-    def query(self, query):
-        context = f"""
-        You are an AI assistant that determines the type of SQL query based on natural language instructions.
+        log.info("Detected SQL intent (local): %s", intent)
+        return {"intent": intent, "query": sql_query}, "local"
 
-        Classify the following instruction as one of:
+    def generate_translation(self, natural_language_query, deadline=None, on_token=None):
+        prompt = self.translation_prompt(natural_language_query)
+        response_text = invoke_llm(self.llm, prompt, deadline, stage="llm_classify_generate", on_token=on_token)
+        return self.parse_translation(response_text)
+
+    def translation_prompt(self, natural_language_query):
+        return f"""
+        You are an AI assistant that converts natural language instructions into SQL statements for MySQL.
+
+        MySQL Database: Music
+        Tables and their columns:
+        {self.schema_context(natural_language_query)}
+
+        First classify the instruction as one of:
         - "modification" (if it involves INSERT, UPDATE, DELETE, CREATE, DROP, ALTER)
         - "select" (if it involves reading data with SELECT)
 
-        Only return "modification" or "select" as the output. Do not explain or provide SQL code.
+        Then write the SQL statement for it:
+        - Tables may contain related data split across them (e.g., track metadata in one table and track audio features in another).
+        - Be smart about using JOINs if required — for example, if a column is not found in one table, check if it's in another table and use a JOIN via a shared key (like album_id).
+        - Always include table names when referencing columns (e.g., tracks.name, sounds.energy).
+        - For modifications, use valid data types for all fields. If unsure, use reasonable defaults or mock values.
+        - Only generate valid SQL statements for MySQL.
+
+        The output must be a valid JSON object with this structure:
+
+        {{
+            "intent": "select" | "modification",
+            "query": "the SQL statement"
+        }}
+
+        Do NOT return extra text or explanations—only the JSON object.
 
-        Instruction: "{query}"
+        Instruction: "{natural_language_query}"
         """
 
-        response = self.llm.invoke(context)
-        response_text = response.content if hasattr(response, "content") else str(response)
+    def parse_translation(self, response_text):
+        translation = parse_json_response(response_text)
+        if not translation or translation.get("intent") not in ("select", "modification") or not translation.get("query"):
+            log.warning("LLM response does not contain expected structure.")
+            return None
 
-        response_text = response_text.strip().lower()
-        print("Detected SQL Intent:", response_text)
+        sql_query = re.sub(r"^```(?:sql)?|```$", "", str(translation["query"]).strip(), flags=re.MULTILINE).strip()
+        log.info("Detected SQL intent (llm): %s", translation["intent"])
+        log.info("Generated SQL: %s", sql_query)
+        return {"intent": translation["intent"], "query": sql_query}
 
-        if response_text == "select":
-            output = self.run_select_query_direct(query)
-            output["intent"] = "select"
-            return output
-        elif response_text == "modification":
-            output = self.run_modification_query(query)
-            output["intent"] = "modification"
-            return output
-        
-        return "Unexpected output."
+    def run_translation(self, translation, deadline=None):
+        if translation["intent"] == "select":
+            output = self.execute_select_query(translation["query"], deadline, translation.get("params"))
+        else:
+            output = self.execute_modification_query(translation["query"], deadline)
+
+        if isinstance(output, dict):
+            output["intent"] = translation["intent"]
+        return output
 
-    def generate_select_query(self, natural_language_query):
+    def generate_select_query(self, natural_language_query, deadline=None, on_token=None):
         context = f"""
         You are an AI assistant that converts natural language instructions into SQL SELECT queries.
 
         MySQL Database: Music
         Tables and their columns:
-        {self.db.get_table_info()}
+        {self.schema_context(natural_language_query)}
 
         Important notes:
         - Tables may contain related data split across them (e.g., track metadata in one table and track audio features in another).
@@ -81,44 +405,140 @@ class SQLHandler(BaseCallbackHandler):
         Instruction: "{natural_language_query}"
         """
 
-        response = self.llm.invoke(context)
-        response_text = response.content if hasattr(response, "content") else str(response)
+        response_text = invoke_llm(self.llm, context, deadline, on_token=on_token)
 
         # Clean potential markdown formatting (```sql ... ```)
         response_text = re.sub(r"^```(?:sql)?|```$", "", response_text.strip(), flags=re.MULTILINE).strip()
 
-        print("Generated SQL (SELECT):", response_text)
+        log.info("Generated SQL (SELECT): %s", response_text)
         return response_text
     
-    def run_select_query_direct(self, natural_language_query):
+    def run_select_query_direct(self, natural_language_query, deadline=None):
         # Step 1: Generate SQL
-        sql_query = self.generate_select_query(natural_language_query)
+        sql_query = self.generate_select_query(natural_language_query, deadline)
 
-        sql_result = None
         # Step 2: Execute SQL
+        return self.execute_select_query(sql_query, deadline)
+
+    def execute_select_query(self, sql_query, deadline=None, params=None):
+        sql_result = None
+        columns = []
+        total_rows = None
+        stream = None
+        guard_decision = None
+
+        # Results of earlier identical queries are reused until a modification touches their tables
+        generated_query = [sql_query, params] if params else sql_query
+        if sql_query and self.result_cache:
+            cached = self.result_cache.get(self.cache_namespace, generated_query)
+            CACHE_REQUESTS.inc(cache="result", result="hit" if cached else "miss")
+            if cached:
+                log.debug("Result cache hit")
+                ROWS_RETURNED.observe(len(cached["sql_result"]), backend="mysql")
+                return {**cached, "has_more": False, "stream": None, "result_cache": "hit"}
+            generation = self.result_cache.generation(self.cache_namespace)
+
+        if sql_query and self.guard:
+            with span("guard", backend="mysql"):
+                sql_query, guard_decision = self.guard.check_sql(self.engine, sql_query, deadline, params=params)
+            if guard_decision["action"] == "reject":
+                return {
+                    "query": sql_query,
+                    "params": params,
+                    "sql_result": describe_decision(guard_decision),
+                    "columns": [],
+                    "total_rows": None,
+                    "has_more": False,
+                    "stream": None,
+                    "guard": guard_decision
+                }
+
         if sql_query:
-            with self.engine.begin() as connection:
-                result = connection.execute(text(sql_query))
-                if result.returns_rows:
-                    sql_result = result.fetchall()
-                    columns = result.keys()
-                else:
-                    sql_result = f"{result.rowcount} rows affected."
+            with span("db_execute", backend="mysql"):
+                stream = SelectResultStream(self.engine, sql_query, page_size=self.preview_rows, deadline=deadline, params=params)
+            if stream.returns_rows:
+                # Only the preview window is read, the rest stays on the server until paged in
+                with span("db_fetch", backend="mysql"):
+                    sql_result = stream.fetch_page(deadline)
+                ROWS_RETURNED.observe(len(sql_result), backend="mysql")
+                columns = stream.columns
+                if stream.exhausted:
+                    total_rows = stream.rows_fetched
+                elif self.count_total:
+                    with span("db_count", backend="mysql"):
+                        total_rows = self.count_rows(sql_query, deadline, params)
+            else:
+                sql_result = f"{stream.rowcount} rows affected."
+
+        # Only results that were read completely are cached
+        if self.result_cache and stream and stream.returns_rows and stream.exhausted:
+            self.result_cache.set(self.cache_namespace, generated_query, referenced_tables(sql_query), {
+                "query": sql_query,
+                "params": params,
+                "sql_result": [tuple(row) for row in sql_result],
+                "columns": list(columns),
+                "total_rows": total_rows,
+                "guard": guard_decision
+            }, generation)
 
         return {
             "query": sql_query,
+            "params": params,
             "sql_result": sql_result,
-            "columns": columns
+            "columns": columns,
+            "total_rows": total_rows,
+            "has_more": bool(stream and not stream.exhausted),
+            "stream": stream if stream and not stream.exhausted else None,
+            "guard": guard_decision
         }
 
-    def generate_modification_query(self, natural_language_query):
-        print(self.db.get_table_info())
+    def export_select(self, sql_query, chunk_size=5000, deadline=None, params=None):
+        """
+        Yields the complete result of a SELECT as RowChunks of up to chunk_size
+        row dicts, for exports. Column names that occur more than once get a
+        suffix. The guard still rejects queries that are too expensive, but
+        does not add its LIMIT.
+        """
+        if not sql_query.strip().lower().startswith(("select", "with")):
+            raise ValueError("Only SELECT results can be exported.")
+        if self.guard:
+            with span("guard", backend="mysql"):
+                sql_query, guard_decision = self.guard.check_sql(self.engine, sql_query, deadline, add_limit=False, params=params)
+            if guard_decision["action"] == "reject":
+                raise ValueError(describe_decision(guard_decision))
+
+        with span("db_execute", backend="mysql"):
+            stream = SelectResultStream(self.engine, sql_query, page_size=chunk_size, deadline=deadline, params=params)
+        columns = unique_columns(stream.columns)
+        try:
+            while not stream.exhausted:
+                with span("db_fetch", backend="mysql"):
+                    rows = stream.fetch_page(deadline)
+                yield RowChunk([dict(zip(columns, row)) for row in rows], columns)
+        finally:
+            stream.close()
+
+    def count_rows(self, sql_query, deadline=None, params=None):
+        try:
+            with self.engine.connect() as connection:
+                counted = f"SELECT COUNT(*) FROM ({sql_query.strip().rstrip(';')}) AS counted_rows"
+                with kill_query_on_deadline(self.engine, connection, deadline):
+                    return connection.execute(text(counted), params or {}).scalar()
+        except QueryTimeout:
+            # The preview is still worth showing without a total
+            log.warning("Counting result rows exceeded the query deadline.")
+            return None
+        except Exception as e:
+            log.warning("Could not count result rows: %s", e)
+            return None
+
+    def generate_modification_query(self, natural_language_query, deadline=None, on_token=None):
         context = f"""
         You are an AI assistant that converts natural language instructions into SQL data modification statements.
 
         MySQL Database: Music
         Tables and their columns:
-        {self.db.get_table_info()}
+        {self.schema_context(natural_language_query)}
 
         Important rules:
         - Use valid data types for all fields. If unsure, use reasonable defaults or mock values.
@@ -132,56 +552,106 @@ class SQLHandler(BaseCallbackHandler):
         Instruction: "{natural_language_query}"
         """
 
-        response = self.llm.invoke(context)
-        response_text = response.content if hasattr(response, "content") else str(response)
+        response_text = invoke_llm(self.llm, context, deadline, on_token=on_token)
 
         # Clean potential markdown formatting (```sql ... ```)
         response_text = re.sub(r"^```(?:sql)?|```$", "", response_text.strip(), flags=re.MULTILINE).strip()
 
-        print("LLM Response (SQL):", response_text)
+        log.info("Generated SQL: %s", response_text)
         return response_text
     
-    def run_modification_query(self, natural_language_query):
-        try:
-            sql = self.generate_modification_query(natural_language_query)
+    def run_modification_query(self, natural_language_query, deadline=None):
+        sql = self.generate_modification_query(natural_language_query, deadline)
+        return self.execute_modification_query(sql, deadline)
 
+    def execute_modification_query(self, sql, deadline=None):
+        try:
             if not sql.lower().startswith(("insert", "update", "delete")):
                 raise ValueError("Detected a non-modification query. Only INSERT, UPDATE, DELETE are allowed.")
 
-            with self.engine.begin() as conn:
-                result = conn.execute(text(sql))
-                return {"query": sql, "rows_mod": result.rowcount}
-                
+            with span("db_execute", backend="mysql"), self.engine.begin() as conn:
+                with kill_query_on_deadline(self.engine, conn, deadline):
+                    result = conn.execute(text(sql))
+                rows_mod = result.rowcount
+
+            # Sample rows in the cached table info and cached results of these tables are outdated now
+            self.schema.invalidate()
+            if self.result_cache:
+                self.result_cache.invalidate(self.cache_namespace, referenced_tables(sql))
+            return {"query": sql, "rows_mod": rows_mod}
+
+        except QueryTimeout:
+            raise
         except Exception as e:
             return "There was an error. "+str(e)
 
 
 ## MONGO HANDLER
 class MongoHandler:
-    def __init__(self, llm, ip, db_name):
+    def __init__(self, llm, ip, db_name, cache=None, batch_size=500, result_cap=1000, pool_options=None, guard=None, result_cache=None, client=None,
+                 schema_sample_size=200, schema_refresh_interval=300, schema_cache_path=None, schema_top_k=None, embedder=None, templates=None):
         self.ip = ip
         self.db_name = db_name
+        self.cache = cache
+        # Optional TemplateStore, questions that only differ in literals from an earlier one reuse its pipeline
+        self.templates = templates
+
+        # Aggregation results are read from the cursor in batches and capped at result_cap documents
+        self.batch_size = batch_size
+        self.result_cap = result_cap
+
+        # Optional QueryGuard that adds a $limit and checks explain() before pipelines run
+        self.guard = guard
+
+        # Optional ResultCache shared with other handlers, entries are tagged with the collections they read
+        self.result_cache = result_cache
+        self.cache_namespace = f"mongodb://{ip}/{db_name}"
 
         MONGO_URI = "mongodb://"+str(self.ip)
         DB_NAME = db_name
 
-        self.client = MongoClient(MONGO_URI)
+        # Clients are shared per URI, see pools.py for the pool settings. A client can also be passed
+        # in directly, e.g. a mongomock client for benchmarks
+        self.client = client or get_mongo_client(MONGO_URI, **(pool_options or {}))
         self.db = self.client[DB_NAME]
         self.llm = llm
 
-        self.collection_attributes = self._get_schema()
-
-    def _get_schema(self):
-        schema = {}
-        collection_names = self.db.list_collection_names()
-        for collection in collection_names:
-            sample_doc = self.db[collection].find_one()
-            if sample_doc:
-                schema[collection] = list(sample_doc.keys())
-        return schema
-
-
-    def generate_query(self, natural_language_query):
+        # Fields, types and indexes are inferred from samples of every collection, loaded from
+        # schema_cache_path when a previous run stored them and kept up to date in the background
+        self.schema = MongoSchemaCache(self.db, self.cache_namespace, sample_size=schema_sample_size,
+                                       refresh_interval=schema_refresh_interval, path=schema_cache_path, embedder=embedder)
+        # With schema_top_k set, prompts only get the top_k collections matching the question and the ones they join with
+        self.schema_top_k = schema_top_k
+
+    def close(self):
+        # The client is shared through pools.py and stays open, only the schema refresh is stopped
+        self.schema.close()
+
+    @property
+    def collection_attributes(self):
+        return self.schema.prompt_info()
+
+    @property
+    def schema_fingerprint(self):
+        # Translations are only reused while the schema they were generated against is unchanged
+        return self.schema.fingerprint
+
+    def schema_context(self, question):
+        collections = self.schema.collections
+        if not self.schema_top_k or len(collections) <= self.schema_top_k:
+            context = json.dumps(self.schema.prompt_info(), indent=2)
+            report_schema_context("mongo", context, len(collections), len(collections))
+            return context
+
+        selected = self.schema.relevant_collections(question, self.schema_top_k)
+        context = json.dumps(self.schema.prompt_info(selected), indent=2)
+        others = [name for name in sorted(collections) if name not in selected]
+        if others:
+            context += "\nOther collections in the database (fields not shown): " + ", ".join(others)
+        report_schema_context("mongo", context, len(selected), len(collections))
+        return context
+
+    def generate_query(self, natural_language_query, deadline=None, on_token=None):
         """
         Enhanced universal query generator that handles all query types:
         - Basic find operations with projections
@@ -193,8 +663,8 @@ class MongoHandler:
         You are an AI assistant that converts natural language queries into valid MongoDB aggregation queries.
 
         MongoDB Database: {self.db.name}
-        Collections and their attributes:
-        {json.dumps(self.collection_attributes, indent=2)}
+        Collections with their document counts, fields (type, and the share of sampled documents having it when not all do) and indexes:
+        {self.schema_context(natural_language_query)}
 
         Convert the following question into a valid MongoDB aggregation query.
         The query **must automatically determine the correct collection**.
@@ -207,6 +677,7 @@ class MongoHandler:
         - If it involves limiting results, use $limit
         - If it involves skipping results, use $skip
         - If it involves selecting specific fields, use $project
+        - Prefer filtering ($match) and sorting ($sort) on indexed fields, and use exact field names from the list above
 
         Always construct MongoDB aggregation pipelines with the correct order of stages. For example, when retrieving the Nth highest value, use $sort followed by $skip and then $limit to ensure accurate results.
         
@@ -222,8 +693,7 @@ class MongoHandler:
         Question: "{natural_language_query}"
         """
 
-        response = self.llm.invoke(context)
-        response_text = response.content if hasattr(response, "content") else str(response)
+        response_text = invoke_llm(self.llm, context, deadline, on_token=on_token)
         response_text = re.sub(r"^```(?:json)?|```$", "", response_text.strip(), flags=re.MULTILINE).strip()
 
         try:
@@ -231,20 +701,20 @@ class MongoHandler:
             if "collection" in query_object and "aggregate" in query_object:
                 return query_object
             else:
-                print("Error: LLM response does not contain expected structure.")
+                log.warning("LLM response does not contain expected structure.")
                 return None
         except json.JSONDecodeError:
-            print("Error: LLM did not return a valid JSON response.")
-            print("Invalid JSON:", response_text)
+            log.warning("LLM did not return a valid JSON response.")
+            log.warning("Invalid JSON: %s", response_text)
             return None
 
-    def generate_modification_query(self, natural_language_query):
+    def generate_modification_query(self, natural_language_query, deadline=None, on_token=None):
         context = f"""
         You are an AI assistant that converts natural language instructions into MongoDB data modification operations.
 
         MongoDB Database: {self.db.name}
-        Collections and their attributes:
-        {json.dumps(self.collection_attributes, indent=2)}
+        Collections with their document counts, fields (type, and the share of sampled documents having it when not all do) and indexes:
+        {self.schema_context(natural_language_query)}
 
         Convert the following instruction into a valid MongoDB data modification JSON.
 
@@ -262,30 +732,29 @@ class MongoHandler:
 
         Instruction: "{natural_language_query}"
         """
-        response = self.llm.invoke(context)
-        response_text = response.content if hasattr(response, "content") else str(response)
+        response_text = invoke_llm(self.llm, context, deadline, on_token=on_token)
 
         response_text = re.sub(r"^```(?:json)?|```$", "", response_text.strip(), flags=re.MULTILINE).strip()
 
-        print("Cleaned LLM Response:", response_text)
+        log.info("Generated MongoDB modification: %s", response_text)
 
         try:
             mod_query = json.loads(response_text)
             if "operation" in mod_query and "collection" in mod_query:
                 return mod_query
             else:
-                print("Error: LLM response does not contain expected structure.")
+                log.warning("LLM response does not contain expected structure.")
                 return None
         except json.JSONDecodeError as e:
-            print("Error: LLM did not return a valid JSON response.")
-            print("Parsing error:", e)
+            log.warning("LLM did not return a valid JSON response.")
+            log.warning("Parsing error: %s", e)
             return None
     
-    def describe_schema(self, natural_language_query):
+    def describe_schema(self, natural_language_query, deadline=None, on_token=None):
         # Construct the context to send to the LLM
         context = {
             "database": self.db.name,
-            "collections": self.collection_attributes
+            "collections": self.schema_context(natural_language_query)
         }
         
         # Prepare the LLM prompt
@@ -303,89 +772,312 @@ class MongoHandler:
         """
 
         # Call the LLM to get the response
-        response = self.llm.invoke(prompt)
-        out = response.content if hasattr(response, 'content') else 'No content available'
+        out = invoke_llm(self.llm, prompt, deadline, stage="llm_schema", on_token=on_token)
 
         return out
     
-    def modify_data(self, nl_instruction):
-        mod_query = self.generate_modification_query(nl_instruction)
+    def modify_data(self, nl_instruction, deadline=None):
+        mod_query = self.generate_modification_query(nl_instruction, deadline)
+        return self.apply_modification(mod_query, deadline)
+
+    def apply_modification(self, mod_query, deadline=None):
         if not mod_query:
             return None
 
+        # insert_one/insert_many add an _id to the documents they are given, so work on a copy
+        # to keep the (possibly cached) translation reusable
+        mod_query = copy.deepcopy(mod_query)
         c, op = self.db[mod_query["collection"]], mod_query["operation"]
 
         try:
-            if op == "insertOne":
-                c.insert_one(mod_query["data"])
-                count = 1
-            elif op == "insertMany":
-                count = len(c.insert_many(mod_query["data"]).inserted_ids)
-            elif op == "updateOne":
-                count = c.update_one(mod_query["filter"], mod_query["update"]).modified_count
-            elif op == "updateMany":
-                count = c.update_many(mod_query["filter"], mod_query["update"]).modified_count
-            elif op == "deleteOne":
-                count = c.delete_one(mod_query["filter"]).deleted_count
-            elif op == "deleteMany":
-                count = c.delete_many(mod_query["filter"]).deleted_count
-            else:
+            with span("db_execute", backend="mongo"), mongo_deadline(deadline):
+                count = self._apply_operation(c, op, mod_query)
+            if count is None:
                 return None
 
+            # Cached results that read this collection are outdated now, and its fields may have changed
+            self.schema.invalidate(mod_query["collection"])
+            if self.result_cache:
+                self.result_cache.invalidate(self.cache_namespace, [mod_query["collection"]])
             return {"mongo_query": mod_query, "rows_mod": count, "intent":"modification"}
 
+        except PyMongoError as e:
+            if e.timeout:
+                raise QueryTimeout("The MongoDB operation exceeded the query deadline.") from e
+            return None
         except Exception:
             return None
 
+    def _apply_operation(self, c, op, mod_query):
+        if op == "insertOne":
+            c.insert_one(mod_query["data"])
+            return 1
+        elif op == "insertMany":
+            return len(c.insert_many(mod_query["data"]).inserted_ids)
+        elif op == "updateOne":
+            return c.update_one(mod_query["filter"], mod_query["update"]).modified_count
+        elif op == "updateMany":
+            return c.update_many(mod_query["filter"], mod_query["update"]).modified_count
+        elif op == "deleteOne":
+            return c.delete_one(mod_query["filter"]).deleted_count
+        elif op == "deleteMany":
+            return c.delete_many(mod_query["filter"]).deleted_count
+        return None
+
     
-    def query(self, nl_query):
+    def query(self, nl_query, context=None):
         """
         Determine the intent of a MongoDB natural language query and route to appropriate handler.
         """
-        context = f"""
-        You are an AI assistant that determines the type of MongoDB operation based on natural language instructions.
-        Classify the following instruction as one of:
+        context = context or RequestContext()
+        deadline = context.deadline
+
+        # Repeated questions are answered from the translation cache without calling the LLM
+        translation = self.cache.get("mongo", nl_query, self.schema_fingerprint) if self.cache else None
+        if self.cache:
+            CACHE_REQUESTS.inc(cache="translation", result="hit" if translation else "miss")
+        if translation:
+            log.debug("Translation cache hit: %s", translation["intent"])
+            INTENT_PATHS.inc(backend="mongo", path="cache")
+            if context.on_translation:
+                context.on_translation(translation)
+            output = self.run_translation(translation, deadline)
+            if isinstance(output, dict):
+                output.update({"cache": "hit", "intent_path": "cache", "llm_calls": 0})
+            return output
+
+        output = self.run_template(nl_query, context)
+        if output is not None:
+            return output
+
+        translation, path = self.translate(nl_query, deadline, context.on_token)
+        INTENT_PATHS.inc(backend="mongo", path=path)
+        if not translation:
+            return "Unexpected intent classification."
+
+        # The generated query can be shown while it runs
+        if context.on_translation:
+            context.on_translation(translation)
+        output = self.run_translation(translation, deadline)
+
+        if isinstance(output, dict):
+            output.update({"intent_path": path, "llm_calls": 1})
+            # Only cache translations that executed successfully
+            if (output.get("guard") or {}).get("action") != "reject":
+                if self.cache:
+                    self.cache.set("mongo", nl_query, self.schema_fingerprint, translation)
+                    output["cache"] = "miss"
+                if self.templates:
+                    self.templates.learn("mongo", nl_query, self.schema_fingerprint, translation)
+        return output
+
+    def run_template(self, nl_query, context):
+        # A pipeline template bound to the question's literals, None when there is none or it does not run
+        translation = self.templates.match("mongo", nl_query, self.schema_fingerprint) if self.templates else None
+        if not translation:
+            return None
+        log.debug("Query template hit: %s", translation["query"])
+        INTENT_PATHS.inc(backend="mongo", path="template")
+        if context.on_translation:
+            context.on_translation(translation)
+        # run_aggregation() returns None when the pipeline fails
+        output = self.run_translation(translation, context.deadline)
+        if not isinstance(output, dict) or (output.get("guard") or {}).get("action") == "reject":
+            self.templates.fallback("mongo")
+            return None
+        output.update({"intent_path": "template", "llm_calls": 0})
+        return output
+
+    def translate(self, nl_query, deadline=None, on_token=None):
+        # Obvious instructions are classified locally and go straight to generation,
+        # everything else gets its intent and query from a single LLM call
+        with span("classify", backend="mongo"):
+            intent = classify_intent(nl_query, "mongo")
+        if intent == "schema":
+            mongo_query = self.describe_schema(nl_query, deadline, on_token)
+        elif intent == "modification":
+            mongo_query = self.generate_modification_query(nl_query, deadline, on_token)
+        elif intent == "query":
+            mongo_query = self.generate_query(nl_query, deadline, on_token)
+        else:
+            return self.generate_translation(nl_query, deadline, on_token), "llm"
+
+        log.info("Detected MongoDB intent (local): %s", intent)
+        return {"intent": intent, "query": mongo_query}, "local"
+
+    def generate_translation(self, natural_language_query, deadline=None, on_token=None):
+        prompt = self.translation_prompt(natural_language_query)
+        response_text = invoke_llm(self.llm, prompt, deadline, stage="llm_classify_generate", on_token=on_token)
+        return self.parse_translation(response_text)
+
+    def translation_prompt(self, natural_language_query):
+        return f"""
+        You are an AI assistant that converts natural language instructions into MongoDB operations.
+
+        MongoDB Database: {self.db.name}
+        Collections with their document counts, fields (type, and the share of sampled documents having it when not all do) and indexes:
+        {self.schema_context(natural_language_query)}
+
+        First classify the instruction as one of:
         - "schema" – if it asks about the database structure, such as showing which collections exist, what attributes (fields) are in each collection, or general questions about the design or metadata of the database
         - "modification" (if it involves adding, inserting, updating, or deleting data)
         - "query" (if it involves finding, retrieving, joining, or aggregating data)
-        Only return "schema", "modification", or "query" as the output. Do not explain.
-        Instruction: "{nl_query}"
+
+        Then produce the "query" field for that intent:
+        - "schema": a brief and concise answer to the question, as a string, based on the collections above.
+        - "query": an aggregation query object {{"collection": "name_of_selected_collection", "aggregate": [ {{ aggregation_pipeline }} ]}}.
+          Use $lookup to join collections, $group for averages, counts and sums, $match to filter, $sort (1 ascending, -1 descending),
+          $skip, $limit and $project, in the correct stage order (e.g. $sort, then $skip, then $limit for the Nth highest value).
+          Prefer $match and $sort on indexed fields and use exact field names from the list above.
+        - "modification": an object {{"operation": "insertOne" | "insertMany" | "updateOne" | "deleteOne" | "updateMany" | "deleteMany",
+          "collection": "collection_name", "filter": {{ optional for delete/update }}, "update": {{ optional for update }}, "data": {{ optional for insert }}}}.
+          If values like bookID or ISBN are required, generate valid-looking dummy values (e.g., '1', 'ISBN001'), not placeholders.
+
+        The output must be a valid JSON object with this structure:
+
+        {{
+            "intent": "schema" | "modification" | "query",
+            "query": ...
+        }}
+
+        Do NOT return extra text or explanations—only the JSON object.
+
+        Instruction: "{natural_language_query}"
         """
-        response = self.llm.invoke(context)
-        response_text = response.content if hasattr(response, "content") else str(response)
-        response_text = response_text.strip().lower()
-        print("Detected MongoDB Intent:", response_text)
-        
-        if response_text == "schema":
-            output = {"intent": "schema"}
-            output["result"] = self.describe_schema(nl_query)
-            return output
-        elif response_text == "modification":
-            output = self.modify_data(nl_query)
-            return output
-        elif response_text == "query":
-            # This is the consolidated query function we already built
-            mongo_query = self.generate_query(nl_query)
-            if not mongo_query:
-                print("Invalid query.")
-                return None
 
-            try:
-                collection_name = mongo_query.get("collection")
-                pipeline = mongo_query.get("aggregate", [])
+    def parse_translation(self, response_text):
+        translation = parse_json_response(response_text)
+        if not translation or translation.get("intent") not in ("schema", "modification", "query"):
+            log.warning("LLM response does not contain expected structure.")
+            return None
+
+        intent, mongo_query = translation["intent"], translation.get("query")
+        if intent == "query" and not (isinstance(mongo_query, dict) and "collection" in mongo_query and "aggregate" in mongo_query):
+            log.warning("LLM response does not contain expected structure.")
+            return None
+        if intent == "modification" and not (isinstance(mongo_query, dict) and "operation" in mongo_query and "collection" in mongo_query):
+            log.warning("LLM response does not contain expected structure.")
+            return None
+
+        log.info("Detected MongoDB intent (llm): %s", intent)
+        return {"intent": intent, "query": mongo_query if intent != "schema" else str(mongo_query)}
+
+    def run_translation(self, translation, deadline=None):
+        if translation["intent"] == "schema":
+            return {"intent": "schema", "result": translation["query"]}
+        elif translation["intent"] == "modification":
+            return self.apply_modification(translation["query"], deadline)
+        return self.run_aggregation(translation["query"], deadline)
+
+    def export_aggregation(self, mongo_query, chunk_size=5000, deadline=None):
+        """
+        Yields the complete result of an aggregation as lists of up to
+        chunk_size documents, for exports. The guard still rejects pipelines
+        that are too expensive, but does not add its $limit.
+        """
+        collection_name = mongo_query.get("collection")
+        pipeline = mongo_query.get("aggregate", [])
+        if not collection_name or collection_name not in self.db.list_collection_names():
+            raise ValueError(f"Collection '{collection_name}' does not exist.")
+        if any(isinstance(stage, dict) and ("$out" in stage or "$merge" in stage) for stage in pipeline):
+            raise ValueError("Pipelines that write with $out or $merge cannot be exported.")
+        if self.guard:
+            with span("guard", backend="mongo"):
+                pipeline, guard_decision = self.guard.check_mongo(self.db, collection_name, pipeline, deadline, add_limit=False)
+            if guard_decision["action"] == "reject":
+                raise ValueError(describe_decision(guard_decision))
+
+        try:
+            with mongo_deadline(deadline):
+                with span("db_execute", backend="mongo"):
+                    cursor = self.db[collection_name].aggregate(pipeline, batchSize=chunk_size)
+                try:
+                    while True:
+                        with span("db_fetch", backend="mongo"):
+                            chunk = list(islice(cursor, chunk_size))
+                        if not chunk:
+                            return
+                        yield chunk
+                finally:
+                    cursor.close()
+        except PyMongoError as e:
+            if e.timeout:
+                raise QueryTimeout("The MongoDB export exceeded its deadline.") from e
+            raise
+
+    def run_aggregation(self, mongo_query, deadline=None):
+        if not mongo_query:
+            log.warning("Invalid query.")
+            return None
 
+        try:
+            collection_name = mongo_query.get("collection")
+            pipeline = mongo_query.get("aggregate", [])
+
+            # Results of earlier identical pipelines are reused until a modification touches their collections
+            generated_query = {"collection": collection_name, "aggregate": pipeline}
+            if self.result_cache:
+                cached = self.result_cache.get(self.cache_namespace, generated_query)
+                CACHE_REQUESTS.inc(cache="result", result="hit" if cached else "miss")
+                if cached:
+                    log.debug("Result cache hit")
+                    ROWS_RETURNED.observe(len(cached["output"]), backend="mongo")
+                    return {**cached, "result_cache": "hit"}
+                generation = self.result_cache.generation(self.cache_namespace)
+
+            with mongo_deadline(deadline):
                 if not collection_name or collection_name not in self.db.list_collection_names():
-                    print(f"Error: Collection '{collection_name}' does not exist.")
+                    log.warning("Collection '%s' does not exist.", collection_name)
                     return None
                 if not isinstance(pipeline, list) or not pipeline:
-                    print("Error: Invalid or empty aggregation pipeline.")
+                    log.warning("Invalid or empty aggregation pipeline.")
                     return None
 
-                results = list(self.db[collection_name].aggregate(pipeline))
-                return {"mongo_query": mongo_query, "pipeline_steps": pipeline, "output": results, "intent": "query"}
+                guard_decision = None
+                if self.guard:
+                    with span("guard", backend="mongo"):
+                        pipeline, guard_decision = self.guard.check_mongo(self.db, collection_name, pipeline, deadline)
+                    mongo_query = {**mongo_query, "aggregate": pipeline}
+                    if guard_decision["action"] == "reject":
+                        return {
+                            "mongo_query": mongo_query,
+                            "pipeline_steps": pipeline,
+                            "output": [],
+                            "truncated": False,
+                            "guard": guard_decision,
+                            "intent": "query"
+                        }
+
+                with span("db_execute", backend="mongo"):
+                    cursor = self.db[collection_name].aggregate(pipeline, batchSize=self.batch_size)
+                try:
+                    # Read one document past the cap to know whether the result was truncated
+                    with span("db_fetch", backend="mongo"):
+                        results = list(islice(cursor, self.result_cap + 1))
+                finally:
+                    cursor.close()
+            truncated = len(results) > self.result_cap
+            ROWS_RETURNED.observe(min(len(results), self.result_cap), backend="mongo")
+            output = {
+                "mongo_query": mongo_query,
+                "pipeline_steps": pipeline,
+                "output": results[:self.result_cap],
+                "truncated": truncated,
+                "guard": guard_decision,
+                "intent": "query"
+            }
+
+            # Only complete results are cached
+            if self.result_cache and not truncated:
+                targets = referenced_collections(collection_name, pipeline)
+                self.result_cache.set(self.cache_namespace, generated_query, targets, output, generation)
+            return output
 
-            except Exception as e:
-                print(f"Error executing MongoDB query: {e}")
-                return None
-        else:
-            return "Unexpected intent classification."
\ No newline at end of file
+        except PyMongoError as e:
+            if e.timeout:
+                raise QueryTimeout("The MongoDB query exceeded its deadline.") from e
+            log.warning("Error executing MongoDB query: %s", e)
+            return None
+        except Exception as e:
+            log.warning("Error executing MongoDB query: %s", e)
+            return None
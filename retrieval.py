@@ -0,0 +1,154 @@
+import logging
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+STOPWORDS = {
+    "a", "an", "the", "of", "and", "or", "in", "on", "at", "for", "to", "with", "by", "from", "is", "are", "was",
+    "be", "that", "this", "it", "its", "what", "which", "who", "whose", "how", "many", "much", "show", "list",
+    "all", "me", "find", "get", "give", "each", "per", "have", "has", "than", "more", "less", "there", "do", "does",
+}
+
+log = logging.getLogger(__name__)
+
+_encoding = None
+
+
+def tokenize(text):
+    # Splits snake_case, camelCase (bookID -> book, id) and punctuation, then strips plural endings
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    tokens = []
+    for word in re.split(r"[^A-Za-z0-9]+", text.lower()):
+        if not word or word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def load_tokenizer():
+    """
+    Loads the model's tokenizer for count_tokens(), meant to be called once at
+    startup: tiktoken downloads the encoding on first use. Without tiktoken
+    or without network, count_tokens() keeps using its estimate.
+    """
+    global _encoding
+    if tiktoken is None or _encoding is not None:
+        return _encoding is not None
+    try:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        log.warning("Could not load the tokenizer, token counts are estimated: %s", e)
+        return False
+    return True
+
+
+def count_tokens(text):
+    # Exact count once load_tokenizer() has loaded the model's tokenizer, a rough estimate otherwise
+    if _encoding is None:
+        return len(text) // 4
+    return len(_encoding.encode(text))
+
+
+def shared_key_links(fields):
+    """
+    Links between tables/collections that share a key-like field (album_id,
+    bookID, ...), for schemas that do not declare their foreign keys. These
+    are the columns JOINs and $lookup stages match on.
+    """
+    owners = {}
+    for name, names in fields.items():
+        for field in names:
+            leaf = field.split(".")[-1]
+            if leaf != "_id" and re.search(r"(_id|Id|ID)$", leaf):
+                owners.setdefault(leaf.lower(), set()).add(name)
+
+    links = {name: set() for name in fields}
+    for names in owners.values():
+        for name in names:
+            links[name] |= names - {name}
+    return links
+
+
+class SchemaIndex:
+    """
+    BM25 index over table/collection names and their column/field names,
+    used to pick the part of the schema a question is about. `links` maps
+    every name to the ones it joins with (foreign keys, $lookup keys), which
+    are added to whatever is selected so the LLM can still write the JOIN.
+
+    `embedder` is an optional langchain Embeddings object. When given, the
+    cosine similarity between the question and each entry is added to the
+    (normalized) BM25 score, which helps with synonyms the names do not
+    contain.
+    """
+    def __init__(self, fields, links=None, embedder=None, k1=1.5, b=0.75):
+        self.names = list(fields)
+        self.links = links or {}
+        self.embedder = embedder
+        self.k1 = k1
+        self.b = b
+
+        # The name itself counts twice, it says more about the entry than any single column does
+        self.documents = {name: tokenize(name) * 2 + [token for field in fields[name] for token in tokenize(field)] for name in self.names}
+        self.average_length = sum(len(tokens) for tokens in self.documents.values()) / max(len(self.names), 1)
+        document_frequency = {}
+        for tokens in self.documents.values():
+            for token in set(tokens):
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        self.idf = {
+            token: math.log(1 + (len(self.names) - count + 0.5) / (count + 0.5))
+            for token, count in document_frequency.items()
+        }
+
+        self.vectors = None
+        if embedder is not None and self.names:
+            texts = [f"{name}: {', '.join(fields[name])}" for name in self.names]
+            self.vectors = dict(zip(self.names, embedder.embed_documents(texts)))
+
+    def scores(self, question):
+        terms = tokenize(question)
+        scores = {}
+        for name, tokens in self.documents.items():
+            score = 0.0
+            length_norm = self.k1 * (1 - self.b + self.b * len(tokens) / max(self.average_length, 1))
+            for term in set(terms):
+                frequency = tokens.count(term)
+                if frequency:
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + length_norm)
+            scores[name] = score
+
+        if self.vectors:
+            best = max(scores.values()) or 1.0
+            query_vector = self.embedder.embed_query(question)
+            scores = {name: score / best + cosine(query_vector, self.vectors[name]) for name, score in scores.items()}
+        return scores
+
+    def select(self, question, top_k):
+        """
+        Names of the top_k entries for the question plus their linked entries,
+        in index order. Returns every name when nothing matches, since an
+        empty schema would be worse than a full one.
+        """
+        scores = self.scores(question)
+        ranked = [name for name in sorted(self.names, key=lambda name: -scores[name]) if scores[name] > 0][:top_k]
+        if not ranked:
+            return list(self.names)
+
+        selected = set(ranked)
+        for name in ranked:
+            selected |= self.links.get(name, set())
+        return [name for name in self.names if name in selected]
+
+
+def cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
@@ -0,0 +1,354 @@
+import concurrent.futures
+import json
+import logging
+import os
+import tempfile
+import threading
+from langchain_community.utilities import SQLDatabase
+from sqlalchemy import inspect
+from sqlalchemy.sql import text
+from cache import fingerprint
+from retrieval import SchemaIndex, shared_key_links
+
+log = logging.getLogger(__name__)
+
+# Only fields found in at least this share of the sampled documents count towards the MongoDB schema
+# fingerprint; rarer ones come and go between samples and would throw away every cached translation
+FINGERPRINT_MIN_FREQUENCY = 0.5
+
+MYSQL_COLUMNS_QUERY = """
+    SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE()
+    ORDER BY TABLE_NAME, ORDINAL_POSITION
+"""
+
+MYSQL_TABLES_QUERY = """
+    SELECT TABLE_NAME, COALESCE(UPDATE_TIME, CREATE_TIME)
+    FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = DATABASE()
+    ORDER BY TABLE_NAME
+"""
+
+
+class SQLSchemaCache:
+    """
+    Snapshot of the table info used in SQL prompts. get_table_info() on
+    SQLDatabase reflects the tables and runs sample-row SELECTs every time,
+    so it is built once here and only rebuilt in a background thread when a
+    cheap fingerprint read from information_schema changes, or when
+    invalidate() is called after a modification.
+
+    `fingerprint` only covers table and column definitions, so new rows do
+    not invalidate translations generated against the same structure.
+
+    The info is also kept per table, with a SchemaIndex over the table and
+    column names, so prompts can include only the tables a question needs.
+    """
+    def __init__(self, engine, refresh_interval=60, embedder=None):
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.embedder = embedder
+
+        self.db = None
+        self.table_info = None
+        self.tables = {}
+        self.index = None
+        self.fingerprint = None
+        self._source_fingerprint = None
+
+        self._lock = threading.Lock()
+        self._refresh_requested = threading.Event()
+        self._closed = threading.Event()
+
+        self.refresh()
+        threading.Thread(target=self._refresh_loop, daemon=True, name="sql-schema-refresh").start()
+
+    def close(self):
+        # Stops the background refresh, e.g. when the handler owning this cache failed to start
+        self._closed.set()
+        self._refresh_requested.set()
+
+    def get_table_info(self, table_names=None):
+        if table_names is None:
+            return self.table_info
+        tables = self.tables
+        return "\n\n".join(tables[name] for name in table_names if name in tables)
+
+    def relevant_tables(self, question, top_k):
+        return self.index.select(question, top_k)
+
+    def invalidate(self):
+        # Requests keep using the current snapshot until the background rebuild swaps it
+        self._refresh_requested.set()
+
+    def refresh(self):
+        with self._lock:
+            structure, data = self._read_fingerprint()
+            db = SQLDatabase(self.engine)
+            names = sorted(db.get_usable_table_names())
+            # SQLDatabase joins the info of several tables with blank lines, so this matches get_table_info()
+            tables = {name: db.get_table_info(table_names=[name]) for name in names}
+            index = self._build_index(names)
+
+            self.db, self.tables, self.index = db, tables, index
+            self.table_info = "\n\n".join(tables.values())
+            self.fingerprint = structure
+            self._source_fingerprint = (structure, data)
+        log.info("Schema snapshot refreshed: %s", structure[:12])
+
+    def _build_index(self, names):
+        inspector = inspect(self.engine)
+        columns = {name: [column["name"] for column in inspector.get_columns(name)] for name in names}
+
+        # Declared foreign keys in both directions, plus shared *_id columns for undeclared ones
+        links = shared_key_links(columns)
+        for name in names:
+            for foreign_key in inspector.get_foreign_keys(name):
+                referred = foreign_key.get("referred_table")
+                if referred in links:
+                    links[name].add(referred)
+                    links[referred].add(name)
+        return SchemaIndex(columns, links, embedder=self.embedder)
+
+    def _read_fingerprint(self):
+        if self.engine.dialect.name == "mysql":
+            with self.engine.connect() as conn:
+                columns = conn.execute(text(MYSQL_COLUMNS_QUERY)).fetchall()
+                tables = conn.execute(text(MYSQL_TABLES_QUERY)).fetchall()
+            return fingerprint([tuple(row) for row in columns]), fingerprint([tuple(row) for row in tables])
+
+        # Other dialects have no cheap change marker, so only the structure is compared
+        inspector = inspect(self.engine)
+        columns = [
+            (table, column["name"], str(column["type"]))
+            for table in inspector.get_table_names()
+            for column in inspector.get_columns(table)
+        ]
+        return fingerprint(columns), None
+
+    def _refresh_loop(self):
+        while True:
+            self._refresh_requested.wait(self.refresh_interval)
+            if self._closed.is_set():
+                return
+            forced = self._refresh_requested.is_set()
+            self._refresh_requested.clear()
+            try:
+                if forced or self._read_fingerprint() != self._source_fingerprint:
+                    self.refresh()
+            except Exception as e:
+                log.warning("Error refreshing schema snapshot: %s", e)
+
+
+# Python types of decoded BSON values, by their BSON type name as shown in the prompt
+BSON_TYPE_NAMES = {
+    str: "string", bool: "bool", int: "int", float: "double", dict: "object", list: "array",
+    type(None): "null", bytes: "binData", "ObjectId": "objectId", "datetime": "date",
+    "Decimal128": "decimal", "Int64": "long", "Timestamp": "timestamp", "Regex": "regex",
+}
+MAX_FIELD_DEPTH = 3
+MAX_PROMPT_FIELDS = 100
+
+_schema_file_lock = threading.Lock()
+
+
+def bson_type_name(value):
+    return BSON_TYPE_NAMES.get(type(value)) or BSON_TYPE_NAMES.get(type(value).__name__, type(value).__name__)
+
+
+def document_fields(document, prefix="", depth=0):
+    # (dotted path, type) pairs of one document, descending into subdocuments and arrays of subdocuments
+    fields = set()
+    for key, value in document.items():
+        path = f"{prefix}{key}"
+        fields.add((path, bson_type_name(value)))
+        if depth + 1 >= MAX_FIELD_DEPTH:
+            continue
+        if isinstance(value, dict):
+            fields |= document_fields(value, f"{path}.", depth + 1)
+        elif isinstance(value, list):
+            for item in value[:20]:
+                if isinstance(item, dict):
+                    fields |= document_fields(item, f"{path}.", depth + 1)
+    return fields
+
+
+class MongoSchemaCache:
+    """
+    Field names, types and frequencies plus index definitions of every
+    collection, inferred from a $sample of sample_size documents. All
+    collections are sampled concurrently.
+
+    The result is written to a JSON file at `path` (one entry per `key`,
+    i.e. per database) and loaded from there on the next start, in which case
+    startup does not wait for MongoDB at all. A background thread then checks
+    every collection's document count and indexes every refresh_interval
+    seconds and only resamples collections that changed or were passed to
+    invalidate().
+    """
+    def __init__(self, db, key, sample_size=200, refresh_interval=300, path=None, max_workers=8, embedder=None):
+        self.db = db
+        self.key = key
+        self.sample_size = sample_size
+        self.refresh_interval = refresh_interval
+        self.path = path
+        self.max_workers = max_workers
+        self.embedder = embedder
+
+        self.collections = {}
+        self.fingerprint = None
+        self.index = None
+
+        self._lock = threading.Lock()
+        self._refresh_requested = threading.Event()
+        self._closed = threading.Event()
+        self._stale = set()
+
+        cached = self._load()
+        if cached is not None:
+            self._set(cached)
+            log.info("Loaded cached MongoDB schema for %s (%d collections)", key, len(cached))
+            # Bring the cached copy up to date without holding up startup
+            self._refresh_requested.set()
+        else:
+            self.refresh()
+        threading.Thread(target=self._refresh_loop, daemon=True, name="mongo-schema-refresh").start()
+
+    def close(self):
+        # Stops the background refresh, e.g. when the handler owning this cache failed to start
+        self._closed.set()
+        self._refresh_requested.set()
+
+    def invalidate(self, collection=None):
+        # The collection is resampled by the background thread, the current snapshot stays in use until then
+        if collection:
+            self._stale.add(collection)
+        self._refresh_requested.set()
+
+    def refresh(self, force=()):
+        with self._lock:
+            names = self.db.list_collection_names()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(names)))) as executor:
+                infos = list(executor.map(lambda name: self._collection_info(name, force), names))
+            collections = dict(zip(names, infos))
+            self._set(collections)
+            self._save(collections)
+        log.info("MongoDB schema refreshed: %s", self.fingerprint[:12])
+
+    def relevant_collections(self, question, top_k):
+        return self.index.select(question, top_k)
+
+    def prompt_info(self, collection_names=None):
+        # Compact description for the prompts: "type" per field with the share of sampled documents
+        # that have it when that is not all of them, and the indexed key patterns
+        info = {}
+        for name, collection in sorted(self.collections.items()):
+            if collection_names is not None and name not in collection_names:
+                continue
+            fields = sorted(collection["fields"].items(), key=lambda item: (-item[1]["frequency"], item[0]))[:MAX_PROMPT_FIELDS]
+            described = {}
+            for path, field in fields:
+                types = "|".join(sorted(field["types"], key=lambda t: -field["types"][t]))
+                described[path] = types if field["frequency"] >= 1 else f"{types}, {round(field['frequency'] * 100)}%"
+            info[name] = {
+                "documents": collection["count"],
+                "fields": described,
+                "indexes": [
+                    ", ".join(f"{field} {direction}" for field, direction in index["key"]) + (" (unique)" if index["unique"] else "")
+                    for index in collection["indexes"]
+                ],
+            }
+        return info
+
+    def _collection_info(self, name, force=()):
+        collection = self.db[name]
+        count = collection.estimated_document_count()
+        indexes = [
+            {"name": index_name, "key": [[field, direction] for field, direction in spec["key"]], "unique": bool(spec.get("unique"))}
+            for index_name, spec in sorted(collection.index_information().items())
+            if index_name != "_id_"
+        ]
+
+        previous = self.collections.get(name)
+        if previous and name not in force and previous["count"] == count and previous["indexes"] == indexes:
+            return previous
+
+        types, documents = {}, {}
+        sampled = 0
+        for document in collection.aggregate([{"$sample": {"size": self.sample_size}}]):
+            sampled += 1
+            fields = document_fields(document)
+            for path, type_name in fields:
+                types.setdefault(path, {}).setdefault(type_name, 0)
+                types[path][type_name] += 1
+            # A path can have several types within one document (e.g. in an array), count the document once
+            for path in {path for path, _ in fields}:
+                documents[path] = documents.get(path, 0) + 1
+
+        fields = {
+            path: {"types": types[path], "frequency": round(documents[path] / sampled, 3)}
+            for path in types
+        }
+        return {"count": count, "sampled": sampled, "fields": fields, "indexes": indexes}
+
+    def _set(self, collections):
+        # Collections sharing a key field (e.g. bookID) are the ones $lookup stages join
+        fields = {name: sorted(info["fields"]) for name, info in sorted(collections.items())}
+        self.index = SchemaIndex(fields, shared_key_links(fields), embedder=self.embedder)
+        self.collections = collections
+        # Only the stable structure goes into the fingerprint so translations survive new documents
+        self.fingerprint = fingerprint(self.key, {
+            name: [
+                sorted(path for path, field in info["fields"].items() if field["frequency"] >= FINGERPRINT_MIN_FREQUENCY),
+                [index["key"] for index in info["indexes"]],
+            ]
+            for name, info in collections.items()
+        })
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                return json.load(f).get(self.key)
+        except (OSError, ValueError) as e:
+            log.warning("Could not read cached MongoDB schema: %s", e)
+            return None
+
+    def _save(self, collections):
+        if not self.path:
+            return
+        with _schema_file_lock:
+            stored = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        stored = json.load(f)
+                except (OSError, ValueError):
+                    stored = {}
+            stored[self.key] = collections
+
+            # The lock only covers this process; with --workers every process writes its own temporary file
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            handle, temporary = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(handle, "w") as f:
+                    json.dump(stored, f, default=str)
+                os.replace(temporary, self.path)
+            except Exception:
+                os.remove(temporary)
+                raise
+
+    def _refresh_loop(self):
+        while True:
+            self._refresh_requested.wait(self.refresh_interval)
+            if self._closed.is_set():
+                return
+            self._refresh_requested.clear()
+            stale, self._stale = self._stale, set()
+            try:
+                self.refresh(force=stale)
+            except Exception as e:
+                log.warning("Error refreshing MongoDB schema: %s", e)
@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class BackendUnavailable(RuntimeError):
+    pass
+
+
+class LazyBackend:
+    """
+    Builds a handler (connect, introspect the schema, warm up the pool) in a
+    background thread, so the UI can start before any database answers and
+    a slow or unreachable database does not hold up the other one.
+
+    While the factory fails it is retried with a growing delay, starting at
+    retry_interval and capped at max_retry_interval seconds. get() raises
+    BackendUnavailable right away once an attempt has failed, so questions
+    for a database that is down do not hold a worker. While the first
+    attempt is still running it waits at most `timeout` (and never more than
+    start_wait) seconds.
+    """
+    def __init__(self, name, factory, retry_interval=5, max_retry_interval=60, start_wait=5):
+        self.name = name
+        self.factory = factory
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.start_wait = start_wait
+
+        self.handler = None
+        self.state = "starting"
+        self.error = None
+        self.attempts = 0
+        self.ready_after = None
+        self._attempted = threading.Event()
+        self._started = None
+
+    def start(self):
+        self._started = time.monotonic()
+        threading.Thread(target=self._load, daemon=True, name=f"load-{self.name}").start()
+        return self
+
+    def get(self, timeout=None):
+        if self.state == "unavailable":
+            raise BackendUnavailable(f"{self.name} is not available ({self.error}). Please try again shortly.")
+        if self.state == "starting":
+            self._attempted.wait(self.start_wait if timeout is None else min(timeout, self.start_wait))
+        if self.state == "ready":
+            return self.handler
+        reason = f" ({self.error})" if self.error else ""
+        raise BackendUnavailable(f"{self.name} is not available yet{reason}. Please try again shortly.")
+
+    def status(self):
+        return {"state": self.state, "error": self.error, "attempts": self.attempts, "ready_after": self.ready_after}
+
+    def _load(self):
+        delay = self.retry_interval
+        while True:
+            self.attempts += 1
+            try:
+                handler = self.factory()
+            except Exception as e:
+                self.state, self.error = "unavailable", str(e)
+                self._attempted.set()
+                log.warning("%s is not available (attempt %d), retrying in %ss: %s", self.name, self.attempts, delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+                continue
+
+            self.handler = handler
+            self.state, self.error = "ready", None
+            self.ready_after = round(time.monotonic() - self._started, 1)
+            self._attempted.set()
+            log.info("%s is ready after %ss", self.name, self.ready_after)
+            return
@@ -0,0 +1,256 @@
+import copy
+import re
+import threading
+from cache import normalize_question
+from metrics import TEMPLATE_REQUESTS
+
+# Literal values in a question: quoted text, numbers and capitalized names ("top 10 tracks by Drake")
+LITERAL_PATTERN = re.compile(
+    r"""["“']([^"”']+)["”']"""
+    r"|(?<![\w.])(-?\d+(?:\.\d+)?)(?![\w.])"
+    r"|\b([A-Z](?:[\w&'-]|\.(?=\w))*\.?(?:\s+[A-Z](?:[\w&'-]|\.(?=\w))*\.?)*)"
+)
+SQL_STRING_PATTERN = re.compile(r"'((?:[^'\\]|\\.|'')*)'")
+SQL_NUMBER_PATTERN = re.compile(r"(?<![\w.:])-?\d+(?:\.\d+)?(?![\w.])")
+REGEX_SPECIAL = re.compile(r"[.^$*+?()\[\]{}|\\]")
+# The only text allowed around a literal inside a value: LIKE wildcards in SQL, anchors and .* in a $regex.
+# Anything else ("The Beatles" for "Beatles") would be pasted around every other value bound later
+LIKE_WILDCARDS = re.compile(r"[%_]*")
+REGEX_PREFIX = re.compile(r"\^?(\.\*)?")
+REGEX_SUFFIX = re.compile(r"(\.\*)?\$?")
+
+# Only reading queries are turned into templates
+TEMPLATE_INTENTS = ("select", "query")
+
+
+def extract_literals(question):
+    """
+    The question's shape (normalized, with every literal replaced by a
+    placeholder) and its literals as (kind, text) pairs. The first word is
+    not taken as a name just because it starts the sentence.
+    """
+    literals, shape, position = [], [], 0
+    for match in LITERAL_PATTERN.finditer(question):
+        quoted, number, name = match.groups()
+        start, end = match.span()
+        if name is not None:
+            if start == 0:
+                # "Show tracks by Drake": drop the sentence-initial word, keep the rest of the run
+                rest = re.match(r"\S+\s*", name)
+                name, start = name[rest.end():], rest.end()
+                if not name:
+                    continue
+            # A full stop ends the sentence, unless it belongs to an initial ("J.K.")
+            if name.endswith(".") and not re.search(r"\b\w\.$", name):
+                name, end = name[:-1], end - 1
+        shape.append(question[position:start])
+        if number is not None:
+            literals.append(("number", number))
+            shape.append("<number>")
+        else:
+            literals.append(("text", quoted if quoted is not None else name))
+            shape.append("<text>")
+        position = end
+    shape.append(question[position:])
+    return normalize_question("".join(shape)), literals
+
+
+def _text_slot(kind, literal, value, regex=False):
+    """
+    Where literal sits inside a string value, e.g. LIKE '%Drake%' -> prefix
+    "%", suffix "%". None when the value does not contain it, False when it
+    does but with other text around it, which no template can bind safely.
+    Numbers only count as whole numbers ("2015" in '2015%', not in '20150').
+    """
+    if kind == "number":
+        found = re.search(rf"(?<![\d.]){re.escape(literal)}(?![\d.])", value)
+    else:
+        found = re.search(re.escape(literal), value, re.IGNORECASE)
+    if not found:
+        return None
+    prefix, suffix = value[:found.start()], value[found.end():]
+    if regex:
+        allowed = REGEX_PREFIX.fullmatch(prefix) and REGEX_SUFFIX.fullmatch(suffix)
+    else:
+        allowed = LIKE_WILDCARDS.fullmatch(prefix) and LIKE_WILDCARDS.fullmatch(suffix)
+    if not allowed:
+        return False
+    return {"kind": "text", "prefix": prefix, "suffix": suffix}
+
+
+def _number_matches(literal, value):
+    return float(literal) == float(value)
+
+
+def parameterize_sql(sql_query, literals):
+    """
+    Replaces the SQL literals that come from the question with :t0, :t1, ...
+    bind parameters. Returns (sql, slots) with one slot per question literal
+    (None for literals the query does not use), or None when a literal
+    appears more than once and it is unclear which occurrence it belongs to,
+    or only as part of a longer string.
+    """
+    strings = [(m.start(), m.end(), m.group(1).replace("''", "'")) for m in SQL_STRING_PATTERN.finditer(sql_query)]
+    masked = SQL_STRING_PATTERN.sub(lambda m: " " * len(m.group(0)), sql_query)
+    numbers = [(m.start(), m.end(), m.group(0)) for m in SQL_NUMBER_PATTERN.finditer(masked)]
+
+    slots, replacements, used = [], [], set()
+    for index, (kind, literal) in enumerate(literals):
+        found = [(start, end, _text_slot(kind, literal, value)) for start, end, value in strings]
+        found = [(start, end, slot) for start, end, slot in found if slot is not None]
+        if any(slot is False for _, _, slot in found):
+            return None
+        if kind == "number":
+            found += [(start, end, {"kind": "number"}) for start, end, value in numbers if _number_matches(literal, value)]
+        if len(found) > 1 or any((start, end) in used for start, end, _ in found):
+            return None
+        if not found:
+            slots.append(None)
+            continue
+        start, end, slot = found[0]
+        used.add((start, end))
+        name = f"t{index}"
+        replacements.append((start, end, f":{name}"))
+        slots.append({"param": name, **slot})
+
+    for start, end, text in sorted(replacements, reverse=True):
+        sql_query = sql_query[:start] + text + sql_query[end:]
+    return sql_query, slots
+
+
+def parameterize_pipeline(mongo_query, literals):
+    """
+    Same as parameterize_sql() for an aggregation query: every value in the
+    pipeline that comes from the question is recorded by its path.
+    """
+    values = []
+
+    def walk(value, path):
+        if isinstance(value, dict):
+            for key, inner in value.items():
+                walk(inner, path + [key])
+        elif isinstance(value, list):
+            for position, inner in enumerate(value):
+                walk(inner, path + [position])
+        elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+            values.append((path, value))
+
+    walk(mongo_query["aggregate"], [])
+
+    slots, used = [], set()
+    for kind, literal in literals:
+        found = [(path, _text_slot(kind, literal, value, "$regex" in path)) for path, value in values if isinstance(value, str)]
+        found = [(path, slot) for path, slot in found if slot is not None]
+        if any(slot is False for _, slot in found):
+            return None
+        if kind == "number":
+            found += [(path, {"kind": "number"}) for path, value in values if not isinstance(value, str) and _number_matches(literal, value)]
+        if len(found) > 1 or any(tuple(path) in used for path, _ in found):
+            return None
+        if not found:
+            slots.append(None)
+            continue
+        path, slot = found[0]
+        used.add(tuple(path))
+        # Text that ends up in a $regex has to match literally
+        slots.append({"path": path, "regex": "$regex" in path, **slot})
+    return mongo_query, slots
+
+
+def bind_value(slot, literal):
+    if slot["kind"] == "number":
+        return float(literal) if "." in literal else int(literal)
+    return slot["prefix"] + literal + slot["suffix"]
+
+
+def bind_pipeline(mongo_query, slots, literals):
+    mongo_query = copy.deepcopy(mongo_query)
+    for slot, (_, literal) in zip(slots, literals):
+        if slot is None:
+            continue
+        target = mongo_query["aggregate"]
+        for step in slot["path"][:-1]:
+            target = target[step]
+        value = REGEX_SPECIAL.sub(r"\\\g<0>", literal) if slot["regex"] and slot["kind"] == "text" else literal
+        target[slot["path"][-1]] = bind_value(slot, value)
+    return mongo_query
+
+
+class TemplateStore:
+    """
+    Query templates for questions that only differ in their literal values,
+    e.g. "top 10 tracks by Drake" and "top 5 tracks by Adele". learn() turns
+    a successfully executed translation into a template keyed by the
+    question's shape; match() answers a later question of the same shape by
+    binding its literals, without calling the LLM. SQL templates keep bind
+    parameters, which the driver escapes, instead of pasting values into
+    the query text.
+
+    Templates are kept in `cache` (the TranslationCache), under their own
+    namespace, so they persist across restarts like translations do.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _count(self, backend, result):
+        TEMPLATE_REQUESTS.inc(backend=backend, result=result)
+        with self._lock:
+            self._counts[(backend, result)] = self._counts.get((backend, result), 0) + 1
+
+    def match(self, backend, question, schema_fingerprint):
+        shape, literals = extract_literals(question)
+        template = self.cache.get(f"{backend}-template", shape, schema_fingerprint) if literals else None
+        # Literals the query does not use are part of the pattern and have to be the same
+        if not template or len(template["slots"]) != len(literals) or any(
+            slot is None and fixed.lower() != literal.lower()
+            for slot, fixed, (_, literal) in zip(template["slots"], template["literals"], literals)
+        ):
+            self._count(backend, "miss")
+            return None
+
+        self._count(backend, "hit")
+        translation = template["translation"]
+        if backend == "mysql":
+            params = {slot["param"]: bind_value(slot, literal) for slot, (_, literal) in zip(template["slots"], literals) if slot}
+            return {"intent": translation["intent"], "query": translation["query"], "params": params}
+        return {"intent": translation["intent"], "query": bind_pipeline(translation["query"], template["slots"], literals)}
+
+    def learn(self, backend, question, schema_fingerprint, translation):
+        if translation["intent"] not in TEMPLATE_INTENTS or translation.get("params"):
+            return False
+        shape, literals = extract_literals(question)
+        if not literals:
+            return False
+
+        if backend == "mysql":
+            parameterized = parameterize_sql(translation["query"], literals)
+        else:
+            parameterized = parameterize_pipeline(translation["query"], literals)
+        if parameterized is None or not any(parameterized[1]):
+            return False
+
+        query, slots = parameterized
+        self.cache.set(f"{backend}-template", shape, schema_fingerprint, {
+            "translation": {"intent": translation["intent"], "query": query},
+            "slots": slots,
+            "literals": [literal for _, literal in literals],
+        })
+        self._count(backend, "learned")
+        return True
+
+    def fallback(self, backend):
+        # A bound template failed to run and the question went to the LLM after all
+        self._count(backend, "fallback")
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        stats = {}
+        for (backend, result), count in counts.items():
+            stats.setdefault(backend, {"hit": 0, "miss": 0, "learned": 0, "fallback": 0})[result] = count
+        for backend_stats in stats.values():
+            lookups = backend_stats["hit"] + backend_stats["miss"]
+            backend_stats["hit_rate"] = round(backend_stats["hit"] / lookups, 3) if lookups else 0.0
+        return stats
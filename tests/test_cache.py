@@ -0,0 +1,41 @@
+from cache import referenced_tables
+
+
+def test_referenced_tables_select_and_join():
+    assert referenced_tables("SELECT * FROM tracks") == {"tracks"}
+    assert referenced_tables(
+        "SELECT t.name, a.name FROM tracks t JOIN artists AS a ON a.id = t.artist_id LEFT JOIN albums al ON al.id = t.album_id"
+    ) == {"tracks", "artists", "albums"}
+    assert referenced_tables("SELECT * FROM tracks, artists a WHERE a.id = tracks.artist_id") == {"tracks", "artists"}
+
+
+def test_referenced_tables_qualified_and_quoted():
+    assert referenced_tables("SELECT * FROM `music`.`tracks`") == {"tracks"}
+
+
+def test_referenced_tables_writes():
+    assert referenced_tables("UPDATE tracks SET popularity = 0 WHERE id = 1") == {"tracks"}
+    assert referenced_tables("INSERT INTO playlists (name) VALUES ('Road trip')") == {"playlists"}
+    assert referenced_tables("INSERT INTO top_tracks SELECT * FROM tracks WHERE popularity > 90") == {"top_tracks", "tracks"}
+    assert referenced_tables("DELETE FROM tracks WHERE id = 1") == {"tracks"}
+
+
+def test_referenced_tables_subquery():
+    assert referenced_tables("SELECT * FROM (SELECT * FROM tracks) AS t JOIN artists a ON a.id = t.artist_id") == {"tracks", "artists"}
+
+
+def test_referenced_tables_join_keywords():
+    assert referenced_tables("SELECT * FROM tracks JOIN albums ON albums.id = tracks.album_id") == {"tracks", "albums"}
+    assert referenced_tables("SELECT * FROM tracks STRAIGHT_JOIN albums ON albums.id = tracks.album_id") == {"tracks", "albums"}
+    assert referenced_tables("SELECT * FROM tracks NATURAL JOIN albums") == {"tracks", "albums"}
+
+
+def test_referenced_tables_uncertain_shapes():
+    # The tables next to a derived table in a comma list would be missed, so nothing is trusted
+    assert referenced_tables("SELECT * FROM (SELECT * FROM sounds) s, albums a WHERE s.album_id = a.id") is None
+    assert referenced_tables("SELECT * FROM tracks, (SELECT * FROM albums) a WHERE a.id = tracks.album_id") is None
+    assert referenced_tables("SELECT * FROM tracks t LEFT_JOIN albums a ON a.id = t.album_id") is None
+
+
+def test_referenced_tables_ignores_string_literals():
+    assert referenced_tables("SELECT * FROM tracks WHERE name = 'from (a) b, c'") == {"tracks"}
@@ -0,0 +1,37 @@
+import csv
+import pytest
+from export import RowChunk, write_export
+
+def documents():
+    # Later documents bring a new field and a rating that does not fit the first chunk's type
+    return iter([[{"title": "a", "rating": 4}], [{"title": "b", "rating": 4.5, "subtitle": "x"}]])
+
+
+def test_csv_adds_fields_seen_later(tmp_path):
+    summary = write_export(documents(), "csv", str(tmp_path))
+    with open(summary["path"], newline="") as f:
+        assert list(csv.reader(f)) == [["title", "rating", "subtitle"], ["a", "4", ""], ["b", "4.5", "x"]]
+    assert summary["columns"] == ["title", "rating", "subtitle"]
+    assert summary["rows"] == 2
+
+
+def test_parquet_widens_types_and_adds_fields(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    summary = write_export(documents(), "parquet", str(tmp_path))
+    assert pq.read_table(summary["path"]).to_pylist() == [
+        {"title": "a", "rating": 4.0, "subtitle": None},
+        {"title": "b", "rating": 4.5, "subtitle": "x"},
+    ]
+
+
+def test_parquet_mixed_types_become_text(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    chunks = iter([[{"year": 2015}], [{"year": "unknown"}], [{"year": None}]])
+    summary = write_export(chunks, "parquet", str(tmp_path))
+    assert pq.read_table(summary["path"]).column("year").to_pylist() == ["2015", "unknown", None]
+
+
+def test_empty_result_keeps_header(tmp_path):
+    summary = write_export(iter([RowChunk([], ["name", "name_1"])]), "csv", str(tmp_path))
+    with open(summary["path"], newline="") as f:
+        assert list(csv.reader(f)) == [["name", "name_1"]]
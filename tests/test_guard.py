@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+import pytest
+from guard import LIMIT_PATTERN, QueryGuard
+
+# check_sql() only runs EXPLAIN on MySQL, any other dialect just gets the LIMIT check
+ENGINE = SimpleNamespace(dialect=SimpleNamespace(name="sqlite"))
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM tracks LIMIT 10",
+    "SELECT * FROM tracks limit 10",
+    "SELECT * FROM tracks LIMIT 10 OFFSET 20",
+    "SELECT * FROM tracks LIMIT 20, 10",
+    "SELECT * FROM tracks LIMIT :t0",
+    "SELECT * FROM tracks LIMIT 10  ",
+])
+def test_limit_pattern_finds_limit(sql):
+    assert LIMIT_PATTERN.search(sql)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM tracks",
+    "SELECT * FROM (SELECT * FROM tracks LIMIT 5) AS t",
+    "SELECT * FROM tracks WHERE name = 'limit 5' ORDER BY name",
+    "SELECT speed_limit FROM roads",
+])
+def test_limit_pattern_needs_trailing_limit(sql):
+    assert not LIMIT_PATTERN.search(sql)
+
+
+def test_check_sql_adds_limit():
+    sql, decision = QueryGuard(default_limit=100).check_sql(ENGINE, "SELECT * FROM tracks;")
+    assert sql == "SELECT * FROM tracks LIMIT 100"
+    assert decision["action"] == "rewrite"
+    assert decision["reasons"] == ["Added LIMIT 100."]
+
+
+def test_check_sql_adds_limit_outside_subquery():
+    sql, _ = QueryGuard(default_limit=100).check_sql(ENGINE, "SELECT * FROM (SELECT * FROM tracks LIMIT 5) AS t")
+    assert sql == "SELECT * FROM (SELECT * FROM tracks LIMIT 5) AS t LIMIT 100"
+
+
+def test_check_sql_keeps_existing_limit():
+    sql, decision = QueryGuard().check_sql(ENGINE, "SELECT * FROM tracks ORDER BY popularity DESC LIMIT :t0", params={"t0": 5})
+    assert sql == "SELECT * FROM tracks ORDER BY popularity DESC LIMIT :t0"
+    assert decision["action"] == "allow"
+
+
+def test_check_sql_without_add_limit():
+    sql, decision = QueryGuard().check_sql(ENGINE, "SELECT * FROM tracks", add_limit=False)
+    assert sql == "SELECT * FROM tracks"
+    assert decision["action"] == "allow"
+
+
+@pytest.mark.parametrize("sql", ["UPDATE tracks SET popularity = 0", "DELETE FROM tracks WHERE id = 1"])
+def test_check_sql_leaves_modifications_alone(sql):
+    assert QueryGuard().check_sql(ENGINE, sql) == (sql, {"action": "allow", "reasons": [], "estimated_rows": None, "full_scans": None})
@@ -0,0 +1,38 @@
+import pytest
+from intent import classify_intent
+
+
+@pytest.mark.parametrize("question, backend, expected", [
+    # Reads
+    ("Show the top 10 tracks", "mysql", "select"),
+    ("How many books are there", "mongo", "query"),
+    ("List all albums released in 2015", "mysql", "select"),
+    ("What is the average rating of books", "mongo", "query"),
+    # Clear writes
+    ("Insert a track named Foo into tracks", "mysql", "modification"),
+    ("Delete tracks where popularity < 5", "mysql", "modification"),
+    ("Remove all books from 1999", "mongo", "modification"),
+    ("Update tracks set popularity to 0 where id = 3", "mysql", "modification"),
+    ("Create a table called fans", "mysql", "modification"),
+    ("Drop the index on tracks", "mysql", "modification"),
+    ("Rename column foo to bar", "mysql", "modification"),
+    # Read questions starting with a modification verb go to the LLM (regressions)
+    ("Create a list of the top 10 tracks", "mysql", None),
+    ("Add up the durations of all tracks", "mysql", None),
+    ("Add up the page counts of books to get a total", "mongo", None),
+    ("Change in popularity by year", "mysql", None),
+    ("Update me on the most popular tracks", "mysql", None),
+    # Mixed or unclear
+    ("Show tracks and delete them", "mysql", None),
+    ("Tracks by Drake", "mysql", None),
+    ("", "mysql", None),
+    # Schema questions are only classified for MongoDB
+    ("Which collections are in the database", "mongo", "schema"),
+    ("What fields does books have", "mongo", "schema"),
+    ("Show the schema", "mongo", "schema"),
+    ("Describe the collections", "mongo", "schema"),
+    ("Update the schema of books", "mongo", None),
+    ("Which fields are in tracks", "mysql", "select"),
+])
+def test_classify_intent(question, backend, expected):
+    assert classify_intent(question, backend) == expected
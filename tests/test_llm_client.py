@@ -0,0 +1,63 @@
+import time
+import pytest
+
+langchain_openai = pytest.importorskip("langchain_openai")
+
+from fake_llm_server import start_fake_llm_server
+from llm_client import LLMExecutor, LLMTimeout
+
+ANSWER = "SELECT name FROM tracks ORDER BY popularity DESC LIMIT 10"
+
+
+@pytest.fixture
+def server():
+    server = start_fake_llm_server(lambda prompt: ANSWER, latency=0.05, jitter=0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def chat_model(server):
+    return langchain_openai.ChatOpenAI(model="fake", api_key="test", base_url=server.base_url, max_retries=0, temperature=0)
+
+
+def first_request_takes(server, seconds):
+    # Every request after the first answers right away; requests is counted before delay() is called
+    server.delay = lambda: seconds if server.requests == 1 else 0.05
+
+
+def test_straggler_is_hedged(server):
+    first_request_takes(server, 3)
+    llm = LLMExecutor(chat_model(server), call_timeout=5, hedge_delay=0.3, min_samples=1000, max_attempts=1)
+    started = time.monotonic()
+    assert llm.invoke("Top 10 tracks").content == ANSWER
+    assert time.monotonic() - started < 1.5
+    assert server.requests == 2
+
+
+def test_call_timeout(server):
+    server.delay = lambda: 3
+    llm = LLMExecutor(chat_model(server), call_timeout=1, hedge_percentile=None, max_attempts=1)
+    started = time.monotonic()
+    with pytest.raises(LLMTimeout):
+        llm.invoke("Top 10 tracks")
+    assert 0.9 <= time.monotonic() - started < 2
+
+
+def test_server_error_is_retried(server):
+    def delay():
+        server.error_rate = 1.0 if server.requests == 1 else 0.0
+        return 0.01
+    server.delay = delay
+    llm = LLMExecutor(chat_model(server), hedge_percentile=None, max_attempts=3, backoff=0.01)
+    assert llm.invoke("Top 10 tracks").content == ANSWER
+    assert server.requests == 2
+
+
+def test_stream_is_hedged_on_first_token(server):
+    first_request_takes(server, 3)
+    llm = LLMExecutor(chat_model(server), call_timeout=5, hedge_delay=0.3, min_samples=1000, max_attempts=1)
+    started = time.monotonic()
+    assert "".join(chunk.content for chunk in llm.stream("Top 10 tracks")) == ANSWER
+    assert time.monotonic() - started < 1.5
+    assert server.requests == 2
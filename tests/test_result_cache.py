@@ -0,0 +1,73 @@
+from cache import ResultCache
+
+NAMESPACE = "mysql://music"
+TRACKS = "SELECT * FROM tracks"
+ALBUMS = "SELECT * FROM albums"
+
+
+def store(cache, query, tables, value):
+    cache.set(NAMESPACE, query, tables, value, cache.generation(NAMESPACE))
+
+
+def test_hit_ignores_case_and_whitespace():
+    cache = ResultCache()
+    store(cache, TRACKS, {"tracks"}, ["row"])
+    assert cache.get(NAMESPACE, "select *\n  from tracks;") == ["row"]
+    assert cache.get("mysql://other", TRACKS) is None
+
+
+def test_set_after_a_write_is_dropped():
+    # The write happened while the query ran, so its result may already be stale
+    cache = ResultCache()
+    generation = cache.generation(NAMESPACE)
+    cache.invalidate(NAMESPACE, {"albums"})
+    cache.set(NAMESPACE, TRACKS, {"tracks"}, ["row"], generation)
+    assert cache.get(NAMESPACE, TRACKS) is None
+
+
+def test_set_without_known_tables_is_skipped():
+    cache = ResultCache()
+    store(cache, TRACKS, None, ["row"])
+    assert cache.get(NAMESPACE, TRACKS) is None
+
+
+def test_invalidate_drops_only_entries_of_written_tables():
+    cache = ResultCache()
+    store(cache, TRACKS, {"tracks"}, ["track"])
+    store(cache, ALBUMS, {"albums"}, ["album"])
+    cache.invalidate(NAMESPACE, {"tracks"})
+    assert cache.get(NAMESPACE, TRACKS) is None
+    assert cache.get(NAMESPACE, ALBUMS) == ["album"]
+
+
+def test_invalidate_without_targets_drops_the_namespace():
+    cache = ResultCache()
+    store(cache, TRACKS, {"tracks"}, ["track"])
+    store(cache, ALBUMS, {"albums"}, ["album"])
+    cache.invalidate(NAMESPACE)
+    assert cache.get(NAMESPACE, TRACKS) is None
+    assert cache.get(NAMESPACE, ALBUMS) is None
+
+
+def test_invalidations_are_shared_through_the_log(tmp_path):
+    # Two workers: a write through one drops what the other cached
+    path = str(tmp_path / "invalidations.sqlite3")
+    first, second = ResultCache(path=path), ResultCache(path=path)
+    store(first, TRACKS, {"tracks"}, ["track"])
+    store(first, ALBUMS, {"albums"}, ["album"])
+    generation = first.generation(NAMESPACE)
+
+    second.invalidate(NAMESPACE, {"tracks"})
+    assert first.get(NAMESPACE, TRACKS) is None
+    assert first.get(NAMESPACE, ALBUMS) == ["album"]
+    # A result computed before the other worker's write is not stored either
+    first.set(NAMESPACE, TRACKS, {"tracks"}, ["stale"], generation)
+    assert first.get(NAMESPACE, TRACKS) is None
+
+
+def test_unreadable_log_misses(tmp_path):
+    path = tmp_path / "invalidations.sqlite3"
+    cache = ResultCache(path=str(path))
+    store(cache, TRACKS, {"tracks"}, ["track"])
+    path.write_bytes(b"not a database" * 100)
+    assert cache.get(NAMESPACE, TRACKS) is None
@@ -0,0 +1,104 @@
+import pytest
+from cache import TranslationCache
+from templates import TemplateStore, extract_literals, parameterize_pipeline, parameterize_sql
+
+TOP_TRACKS_SQL = "SELECT name FROM tracks WHERE artist LIKE '%Drake%' ORDER BY popularity DESC LIMIT 10"
+
+
+@pytest.fixture
+def store():
+    return TemplateStore(TranslationCache())
+
+
+def test_extract_literals_same_shape():
+    shape, literals = extract_literals("Show the top 10 tracks by Drake")
+    other_shape, other_literals = extract_literals("Show the top 5 tracks by Adele")
+    assert shape == other_shape == "show the top <number> tracks by <text>"
+    assert literals == [("number", "10"), ("text", "Drake")]
+    assert other_literals == [("number", "5"), ("text", "Adele")]
+
+
+def test_extract_literals_quoted_and_initials():
+    assert extract_literals('Tracks from 2015 with "love" in the title')[1] == [("number", "2015"), ("text", "love")]
+    assert extract_literals("Books by J.K. Rowling")[1] == [("text", "J.K. Rowling")]
+
+
+def test_extract_literals_skips_sentence_initial_word():
+    shape, literals = extract_literals("Show all tracks")
+    assert literals == []
+    assert shape == "show all tracks"
+
+
+def test_parameterize_sql_binds_question_literals():
+    _, literals = extract_literals("Show the top 10 tracks by Drake")
+    sql, slots = parameterize_sql(TOP_TRACKS_SQL, literals)
+    assert sql == "SELECT name FROM tracks WHERE artist LIKE :t1 ORDER BY popularity DESC LIMIT :t0"
+    assert slots == [{"param": "t0", "kind": "number"}, {"param": "t1", "kind": "text", "prefix": "%", "suffix": "%"}]
+
+
+def test_parameterize_sql_unused_literal_gets_no_slot():
+    _, literals = extract_literals("Tracks from 2015 on Spotify")
+    sql, slots = parameterize_sql("SELECT * FROM tracks WHERE year = 2015", literals)
+    assert sql == "SELECT * FROM tracks WHERE year = :t0"
+    assert slots == [{"param": "t0", "kind": "number"}, None]
+
+
+def test_parameterize_sql_ambiguous_literal():
+    # 10 is both the popularity bound and the LIMIT, it is unclear which one the question meant
+    _, literals = extract_literals("Tracks with popularity over 10")
+    assert parameterize_sql("SELECT * FROM tracks WHERE popularity > 10 LIMIT 10", literals) is None
+
+
+def test_match_same_shape(store):
+    assert store.learn("mysql", "Show the top 10 tracks by Drake", "fp", {"intent": "select", "query": TOP_TRACKS_SQL})
+    assert store.match("mysql", "Show the top 5 tracks by Adele", "fp") == {
+        "intent": "select",
+        "query": "SELECT name FROM tracks WHERE artist LIKE :t1 ORDER BY popularity DESC LIMIT :t0",
+        "params": {"t0": 5, "t1": "%Adele%"},
+    }
+    # Templates are tied to the schema they were learned against
+    assert store.match("mysql", "Show the top 5 tracks by Adele", "other") is None
+    assert store.stats()["mysql"]["hit"] == 1
+
+
+def test_match_fixed_literal_must_be_equal(store):
+    # "Spotify" is not in the query, so it is part of the pattern rather than a parameter
+    question = "Show the top 10 tracks on Spotify by Drake"
+    assert store.learn("mysql", question, "fp", {"intent": "select", "query": TOP_TRACKS_SQL})
+    assert store.match("mysql", "Show the top 3 tracks on Deezer by Adele", "fp") is None
+    assert store.match("mysql", "Show the top 3 tracks on Spotify by Adele", "fp")["params"] == {"t0": 3, "t2": "%Adele%"}
+
+
+def test_learn_skips_ambiguous_and_modifications(store):
+    ambiguous = {"intent": "select", "query": "SELECT * FROM tracks WHERE popularity > 10 LIMIT 10"}
+    assert not store.learn("mysql", "Tracks with popularity over 10", "fp", ambiguous)
+    assert store.match("mysql", "Tracks with popularity over 20", "fp") is None
+
+    modification = {"intent": "modification", "query": "DELETE FROM tracks WHERE artist = 'Drake'"}
+    assert not store.learn("mysql", "Delete the tracks by Drake", "fp", modification)
+
+
+def test_literal_inside_longer_string_is_not_learned(store):
+    # Binding "Adele" into 'The <text>' would silently run WHERE name = 'The Adele'
+    translation = {"intent": "select", "query": "SELECT tracks.name FROM tracks JOIN artists ON artists.id = tracks.artist_id "
+                                                 "WHERE artists.name = 'The Beatles'"}
+    assert parameterize_sql(translation["query"], extract_literals("Show all tracks by Beatles")[1]) is None
+    assert not store.learn("mysql", "Show all tracks by Beatles", "fp", translation)
+    assert store.match("mysql", "Show all tracks by Adele", "fp") is None
+
+
+def test_pipeline_literal_inside_longer_string_is_not_learned(store):
+    translation = {"intent": "query", "query": {"collection": "books", "aggregate": [{"$match": {"authors": "J.K. Rowling"}}]}}
+    assert parameterize_pipeline(translation["query"], extract_literals("Books by Rowling")[1]) is None
+    assert not store.learn("mongo", "Books by Rowling", "fp", translation)
+    assert store.match("mongo", "Books by King", "fp") is None
+
+
+def test_wildcards_around_literal_are_kept(store):
+    sql, slots = parameterize_sql("SELECT * FROM tracks WHERE release_date LIKE '2015%'", extract_literals("Tracks from 2015")[1])
+    assert sql == "SELECT * FROM tracks WHERE release_date LIKE :t0"
+    assert slots == [{"param": "t0", "kind": "text", "prefix": "", "suffix": "%"}]
+
+    translation = {"intent": "query", "query": {"collection": "books", "aggregate": [{"$match": {"authors": {"$regex": "^.*Rowling"}}}]}}
+    assert store.learn("mongo", "Books by Rowling", "fp", translation)
+    assert store.match("mongo", "Books by King", "fp")["query"]["aggregate"] == [{"$match": {"authors": {"$regex": "^.*King"}}}]
@@ -0,0 +1,47 @@
+import time
+from cache import TranslationCache
+
+TRANSLATION = {"intent": "select", "query": "SELECT * FROM tracks"}
+
+
+def test_hit_uses_normalized_question_and_schema():
+    cache = TranslationCache()
+    cache.set("mysql", "Show all tracks", "fp", TRANSLATION)
+    assert cache.get("mysql", "  show ALL tracks?", "fp") == TRANSLATION
+    assert cache.get("mysql", "Show all tracks", "changed") is None
+    assert cache.get("mongo", "Show all tracks", "fp") is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 1}
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TranslationCache(max_size=2)
+    cache.set("mysql", "first", "fp", 1)
+    cache.set("mysql", "second", "fp", 2)
+    cache.get("mysql", "first", "fp")
+    cache.set("mysql", "third", "fp", 3)
+    assert cache.get("mysql", "second", "fp") is None
+    assert cache.get("mysql", "first", "fp") == 1
+    assert cache.get("mysql", "third", "fp") == 3
+
+
+def test_entries_expire(tmp_path):
+    cache = TranslationCache(ttl=0.05, path=str(tmp_path / "translations.sqlite3"))
+    cache.set("mysql", "Show all tracks", "fp", TRANSLATION)
+    time.sleep(0.1)
+    assert cache.get("mysql", "Show all tracks", "fp") is None
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "translations.sqlite3")
+    TranslationCache(path=path).set("mysql", "Show all tracks", "fp", TRANSLATION)
+    assert TranslationCache(path=path).get("mysql", "Show all tracks", "fp") == TRANSLATION
+    assert TranslationCache(path=path, ttl=0).get("mysql", "Show all tracks", "fp") is None
+
+
+def test_broken_file_does_not_fail(tmp_path):
+    path = tmp_path / "translations.sqlite3"
+    cache = TranslationCache(path=str(path))
+    path.write_bytes(b"not a database" * 100)
+    cache.set("mysql", "Show all tracks", "fp", TRANSLATION)
+    assert cache.get("mysql", "Show all tracks", "fp") == TRANSLATION
+    assert cache.get("mysql", "Show all albums", "fp") is None